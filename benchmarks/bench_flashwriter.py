@@ -0,0 +1,177 @@
+# End-to-end time of a simulated FOTA download written to a simulated slow
+# flash: erasing the whole slot up front and writing each network chunk
+# synchronously (as fota.update used to), versus flashwriter.SlotWriter with
+# the slot erased up front or erased ahead sector by sector. Runs on the host
+# with CPython:
+#
+#     python benchmarks/bench_flashwriter.py
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import flashwriter
+
+
+SECTOR = 4096
+
+
+class Flash():
+    # programming costs a fixed setup time per call plus a time per byte,
+    # so that many small unaligned writes are slower than few full pages;
+    # erasing costs a fixed time per sector
+
+    def __init__(self, size, call_us, byte_us, erase_us):
+        self.mem = bytearray(size)
+        self.erased = [False] * ((size + SECTOR - 1) // SECTOR)
+        self.call_us = call_us
+        self.byte_us = byte_us
+        self.erase_us = erase_us
+        self.first_write = None
+
+    def erase(self, address, size):
+        sectors = range(address // SECTOR, (address + size + SECTOR - 1) // SECTOR)
+        time.sleep(self.erase_us * len(sectors) / 1e6)
+        for i in sectors:
+            self.erased[i] = True
+
+    def write(self, address, data):
+        if self.first_write is None:
+            self.first_write = time.perf_counter()
+        for i in range(address // SECTOR, (address + len(data) + SECTOR - 1) // SECTOR):
+            assert self.erased[i], 'write to a sector not erased'
+        time.sleep((self.call_us + self.byte_us * len(data)) / 1e6)
+        self.mem[address:address + len(data)] = data
+
+
+def network(image, kbps, min_chunk, max_chunk, seed=1):
+    # yield the image in chunks of random size at the given link speed
+    rnd = random.Random(seed)
+    i = 0
+    while i < len(image):
+        n = rnd.randint(min_chunk, max_chunk)
+        chunk = image[i:i + n]
+        time.sleep(len(chunk) * 8 / (kbps * 1000))
+        i += len(chunk)
+        yield chunk
+
+
+def direct(image, flash, link, page_size):
+    flash.erase(0, len(image))
+    wsize = 0
+    for chunk in network(image, *link):
+        flash.write(wsize, chunk)
+        wsize += len(chunk)
+    return wsize
+
+
+def buffered(image, flash, link, page_size):
+    flash.erase(0, len(image))
+    writer = flashwriter.SlotWriter(0, flash.write, page_size)
+    for chunk in network(image, *link):
+        writer.write(chunk)
+    return writer.close()
+
+
+def erase_ahead(image, flash, link, page_size):
+    writer = flashwriter.SlotWriter(0, flash.write, page_size, erase=flash.erase, size=len(image), sector_size=SECTOR)
+    for chunk in network(image, *link):
+        writer.write(chunk)
+    return writer.close()
+
+
+CASES = [
+    # image size, (kbps, min chunk, max chunk), (call us, byte us, sector erase us), page size
+    ('wifi, 64KB', 64 * 1024, (4000, 100, 1500), (2000, 20, 40000), 2048),
+    ('cellular, 64KB', 64 * 1024, (250, 100, 1500), (2000, 20, 40000), 2048),
+    ('wifi, small chunks', 64 * 1024, (4000, 32, 256), (2000, 20, 40000), 2048),
+]
+
+WRITERS = [('direct', direct), ('buffered', buffered), ('erase ahead', erase_ahead)]
+
+
+def check():
+    # correctness on an instant flash, recording every call
+    page = 512
+    image = os.urandom(3 * SECTOR + 1000)
+
+    def recorder(flash):
+        calls = []
+
+        def write(address, data):
+            calls.append(('write', address, len(data)))
+            flash.write(address, data)
+
+        def erase(address, size):
+            calls.append(('erase', address, size))
+            flash.erase(address, size)
+        return calls, write, erase
+
+    # full stream: contiguous full pages, then the partial one
+    flash = Flash(len(image), 0, 0, 0)
+    calls, write, erase = recorder(flash)
+    writer = flashwriter.SlotWriter(0, write, page, erase=erase, size=len(image), sector_size=SECTOR)
+    for i in range(0, len(image), 700):
+        writer.write(image[i:i + 700])
+    assert writer.close() == len(image)
+    assert flash.mem == image
+    writes = [c for c in calls if c[0] == 'write']
+    assert [c[1] for c in writes] == list(range(0, len(image), page))
+    assert all(c[2] == page for c in writes[:-1])
+    assert sum(c[2] for c in calls if c[0] == 'erase') == len(image)
+
+    # interrupted stream: the partial page is dropped, then resumed by a new
+    # writer without erasing or writing again what is already there
+    flash = Flash(len(image), 0, 0, 0)
+    calls, write, erase = recorder(flash)
+    cut = SECTOR + 1000
+    writer = flashwriter.SlotWriter(0, write, page, erase=erase, size=len(image), sector_size=SECTOR)
+    writer.write(image[:cut])
+    done = writer.close(False)
+    assert done == cut - cut % page and flash.mem[:done] == image[:done]
+    erased = writer.erased
+    del calls[:]
+    writer = flashwriter.SlotWriter(done, write, page, erase=erase, size=len(image) - done, sector_size=SECTOR, erased=erased)
+    writer.write(image[done:])
+    assert done + writer.close() == len(image)
+    assert flash.mem == image
+    assert all(c[1] >= done for c in calls if c[0] == 'write')
+    assert all(c[1] >= erased for c in calls if c[0] == 'erase')
+
+    # errors of the flash write function surface in write or close
+    def failing(address, data):
+        raise IOError('flash')
+    writer = flashwriter.SlotWriter(0, failing, page)
+    try:
+        writer.write(image[:4 * page])
+    except IOError:
+        pass
+    else:
+        assert False, 'write error not raised'
+    # close stops the thread even after an error, and raises it again
+    try:
+        writer.close()
+    except IOError:
+        pass
+    else:
+        assert False, 'write error not raised'
+
+
+def main():
+    check()
+    print('%-20s %-12s %10s %12s' % ('case', 'writer', 'total s', 'first write s'))
+    for name, size, link, cost, page_size in CASES:
+        image = os.urandom(size)
+        for wname, fn in WRITERS:
+            flash = Flash(size, *cost)
+            t0 = time.perf_counter()
+            assert fn(image, flash, link, page_size) == size
+            elapsed = time.perf_counter() - t0
+            assert flash.mem == image
+            print('%-20s %-12s %10.2f %12.2f' % (name, wname, elapsed, flash.first_write - t0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# Peak heap usage of jsonscan.extract versus json.loads on typical AWS IoT
+# payloads. Runs on the host with CPython:
+#
+#     python benchmarks/bench_jsonscan.py
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jsonscan
+
+
+def shadow_delta(nkeys):
+    # layout of the documents published by AWS IoT on .../shadow/update/delta:
+    # state, metadata for each key in state, then timestamp, clientToken and version
+    state = {}
+    metadata = {}
+    for i in range(nkeys):
+        state['knob_%d' % i] = {'value': i, 'unit': 'ms', 'enabled': True}
+        metadata['knob_%d' % i] = {'value': {'timestamp': 1571234567}, 'unit': {'timestamp': 1571234567}, 'enabled': {'timestamp': 1571234567}}
+    return json.dumps({'state': state, 'metadata': metadata, 'timestamp': 1571234567, 'clientToken': 'x' * 32, 'version': 42})
+
+
+def job_execution(doc_size):
+    document = {'operation': 'fota', 'bc_idx': 1, 'bc_size': 123456, 'bc_crc': 'ab' * 16, 'bc_url': 'https://bucket.s3.amazonaws.com/fw.bin?' + 'X' * doc_size}
+    extra = [{'step': i, 'note': 'n' * 40} for i in range(doc_size // 64)]
+    return json.dumps({'clientToken': 'x' * 32, 'timestamp': 1571234567, 'execution': {'jobId': 'job-1', 'status': 'QUEUED', 'versionNumber': 1, 'jobDocument': document}, 'history': extra})
+
+
+def job_list(njobs):
+    item = lambda i: {'jobId': 'job-%d' % i, 'queuedAt': 1571234567, 'lastUpdatedAt': 1571234567, 'executionNumber': 1, 'versionNumber': 1}
+    return json.dumps({'clientToken': 'x' * 32, 'timestamp': 1571234567, 'inProgressJobs': [item(i) for i in range(2)], 'queuedJobs': [item(i) for i in range(njobs)], 'metadata': {'m%d' % i: 'v' * 30 for i in range(njobs)}})
+
+
+def measure(fn, payload, rounds=20):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    result = fn(payload)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    del result
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        fn(payload)
+    elapsed = (time.perf_counter() - t0) / rounds
+    return peak, elapsed
+
+
+CASES = [
+    ('shadow delta, 50 keys', shadow_delta(50), ('state', 'version')),
+    ('shadow delta, 200 keys', shadow_delta(200), ('state', 'version')),
+    ('job execution, 4KB doc', job_execution(4096), ('execution',)),
+    ('job list, 40 jobs', job_list(40), ('inProgressJobs', 'queuedJobs')),
+]
+
+
+def check():
+    # known answers, including bytes payloads, escapes, nesting and missing paths
+    doc = b'{"a": "x\\"}", "b": {"c": [1, {"d": 2}], "e\\"": null}, "f": -1.5e3, "g": [true, false]}'
+    assert jsonscan.extract(doc, ('a', 'b.c', 'f', 'x', 'b.x')) == {'a': 'x"}', 'b.c': [1, {'d': 2}], 'f': -1500.0}
+    assert jsonscan.extract(doc.decode(), ('b',)) == {'b': {'c': [1, {'d': 2}], 'e"': None}}
+    assert jsonscan.extract(bytearray(doc), ()) == {}
+    assert list(jsonscan.items(doc, 'b.c')) == [1, {'d': 2}]
+    assert list(jsonscan.items(doc, 'g')) == [True, False]
+    assert list(jsonscan.items(doc, 'a')) == []
+    assert list(jsonscan.items(b'{"l": []}', 'l')) == []
+
+
+def main():
+    check()
+    print('%-26s %9s %14s %14s %10s %10s' % ('payload', 'bytes', 'loads peak B', 'scan peak B', 'loads ms', 'scan ms'))
+    for name, payload, paths in CASES:
+        assert jsonscan.extract(payload, paths) == {p: json.loads(payload)[p] for p in paths}
+        lpeak, ltime = measure(json.loads, payload)
+        speak, stime = measure(lambda p: jsonscan.extract(p, paths), payload)
+        print('%-26s %9d %14d %14d %10.3f %10.3f' % (name, len(payload), lpeak, speak, ltime * 1000, stime * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Compression ratio of lzss_compress.compress and streaming decode time of
+# lzss.Decoder on firmware-like files (the compiled modules of this library
+# by default, or the files given on the command line). Runs on the host with
+# CPython:
+#
+#     python benchmarks/bench_lzss.py [image.bin ...]
+
+import glob
+import os
+import py_compile
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import lzss
+from lzss_compress import compress
+
+
+def samples():
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path, 'rb') as f:
+                yield os.path.basename(path), f.read()
+        return
+    tmp = tempfile.mkdtemp()
+    for src in sorted(glob.glob(os.path.join(ROOT, '*.py'))):
+        dst = os.path.join(tmp, os.path.basename(src) + 'c')
+        py_compile.compile(src, cfile=dst)
+        with open(dst, 'rb') as f:
+            yield os.path.basename(dst), f.read()
+
+
+def decode(compressed, chunk=512):
+    decoder = lzss.Decoder()
+    out = bytearray()
+    for i in range(0, len(compressed), chunk):
+        out += decoder.feed(compressed[i:i + chunk])
+    return bytes(out)
+
+
+def check():
+    # hand-encoded stream: 3 literals, then a match of length 9 at distance 3
+    assert bytes(lzss.Decoder().feed(b'\x07abc\x18\x02')) == b'abcabcabcabc'
+    assert compress(b'abcabcabcabc') == b'\x07abc\x18\x02'
+    # empty input, overlapping and longest matches, farthest distance; chunks of
+    # 1 to 3 bytes split groups and matches across calls to feed
+    block = os.urandom(1024)
+    cases = [b'', b'x', b'a' * 1000, bytes(range(256)) * 8, block + block, os.urandom(1024) + os.urandom(16) * 40]
+    for data in cases:
+        compressed = compress(data)
+        for chunk in (1, 2, 3, 512):
+            assert decode(compressed, chunk) == data
+    # the second copy of block is encoded as matches 1024 bytes back
+    assert len(compress(block + block)) < 1024 + 1024 // 8 + 64
+
+
+def main():
+    check()
+    print('%-24s %9s %11s %7s %10s' % ('file', 'bytes', 'compressed', 'ratio', 'decode ms'))
+    total = ztotal = 0
+    for name, data in samples():
+        compressed = compress(data)
+        t0 = time.perf_counter()
+        assert decode(compressed) == data
+        elapsed = time.perf_counter() - t0
+        total += len(data)
+        ztotal += len(compressed)
+        print('%-24s %9d %11d %7.2f %10.2f' % (name, len(data), len(compressed), len(compressed) / max(len(data), 1), elapsed * 1000))
+    print('%-24s %9d %11d %7.2f' % ('total', total, ztotal, ztotal / max(total, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Known-answer checks of md5.MD5 (RFC 1321 test suite, chunked updates and
+# state export/restore) and its throughput compared with hashlib. Runs on the
+# host with CPython:
+#
+#     python benchmarks/bench_md5.py
+
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import md5
+
+RFC1321 = [
+    (b'', 'd41d8cd98f00b204e9800998ecf8427e'),
+    (b'a', '0cc175b9c0f1b6a831c399e269772661'),
+    (b'abc', '900150983cd24fb0d6963f7d28e17f72'),
+    (b'message digest', 'f96b697d7cb7938d525a2f31aaf161d0'),
+    (b'abcdefghijklmnopqrstuvwxyz', 'c3fcd3d76192e4007dfb496cca67e13b'),
+    (b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789', 'd174ab98d277d9f5a5611c2c9f419d9f'),
+    (b'1234567890' * 8, '57edf4a22be3c955ac49da2e2107b67a'),
+]
+
+
+def check():
+    for data, expected in RFC1321:
+        assert md5.MD5().hexdigest() == 'd41d8cd98f00b204e9800998ecf8427e'
+        h = md5.MD5()
+        h.update(data)
+        assert h.hexdigest() == expected, data
+    # chunked updates across block boundaries, resumed from exported states
+    data = os.urandom(4099)
+    for step in (1, 7, 63, 64, 65, 512):
+        h = md5.MD5()
+        for i in range(0, len(data), step):
+            h.update(data[i:i + step])
+            h = md5.MD5(h.state())
+        assert h.digest() == hashlib.md5(data).digest(), step
+
+
+def main():
+    check()
+    print('%-10s %12s %12s %10s' % ('size', 'md5.py ms', 'hashlib ms', 'ratio'))
+    for size in (4096, 65536, 524288):
+        data = os.urandom(size)
+        t0 = time.perf_counter()
+        h = md5.MD5()
+        for i in range(0, size, 512):
+            h.update(data[i:i + 512])
+        h.digest()
+        tpy = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        hashlib.md5(data).digest()
+        tnative = time.perf_counter() - t0
+        print('%-10d %12.2f %12.3f %10.0fx' % (size, tpy * 1000, tnative * 1000, tpy / max(tnative, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Compress a firmware image in the LZSS format expanded on the device by
+# lzss.Decoder (see the lzss module for the format). Runs on the host with
+# CPython:
+#
+#     python benchmarks/lzss_compress.py image.bin image.lzss
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lzss import WINDOW, MIN_MATCH, MAX_MATCH
+
+
+def compress(data):
+    # the match finder keeps the last 64 positions of every 3 byte sequence:
+    # far more memory than Decoder needs, fine on the host
+    out = bytearray()
+    chains = {}
+    n = len(data)
+    i = 0
+    flag_at = -1
+    nitems = 8
+    while i < n:
+        if nitems == 8:
+            flag_at = len(out)
+            out.append(0)
+            nitems = 0
+        best = 0
+        best_dist = 0
+        if i + MIN_MATCH <= n:
+            key = bytes(data[i:i + MIN_MATCH])
+            for j in reversed(chains.get(key, ())):
+                if i - j > WINDOW:
+                    break
+                k = MIN_MATCH
+                limit = min(MAX_MATCH, n - i)
+                while k < limit and data[j + k] == data[i + k]:
+                    k += 1
+                if k > best:
+                    best = k
+                    best_dist = i - j
+                    if k == limit:
+                        break
+        if best >= MIN_MATCH:
+            d = best_dist - 1
+            out.append(((best - MIN_MATCH) << 2) | (d >> 8))
+            out.append(d & 0xff)
+            step = best
+        else:
+            out[flag_at] |= 1 << nitems
+            out.append(data[i])
+            step = 1
+        for j in range(i, min(i + step, n - MIN_MATCH + 1)):
+            key = bytes(data[j:j + MIN_MATCH])
+            chain = chains.setdefault(key, [])
+            chain.append(j)
+            if len(chain) > 64:
+                del chain[0]
+        i += step
+        nitems += 1
+    return bytes(out)
+
+
+def main():
+    with open(sys.argv[1], 'rb') as f:
+        data = f.read()
+    compressed = compress(data)
+    with open(sys.argv[2], 'wb') as f:
+        f.write(compressed)
+    print('%d -> %d bytes' % (len(data), len(compressed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+.. module:: aws_iot_flashwriter
+
+******************************
+Streaming Flash Writer Library
+******************************
+
+Data downloaded over the network arrives in chunks of arbitrary size, while flash memories are programmed fastest a page at a time.
+This module collects the incoming data into page aligned buffers and programs them from a separate thread, so that the download of the next page
+proceeds while the previous one is being written. The same thread can also erase the flash sectors just ahead of the data, instead of erasing the whole area before the first byte arrives::
+
+    from aws.iot import flashwriter
+    import fota
+
+    addr = fota.find_bytecode_slot()
+    writer = flashwriter.SlotWriter(addr, fota.write_slot, page_size=512, erase=fota.erase_slot, size=image_size)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+
+    """
+
+import threading
+
+
+class SlotWriter():
+    """
+====================
+The SlotWriter class
+====================
+
+.. class:: SlotWriter(address, write, page_size=512, erase=None, size=None, sector_size=4096, erase_ahead=1, erased=None)
+
+        Create a writer of consecutive data starting at flash :samp:`address`, which should be aligned to :samp:`page_size`.
+
+        :samp:`write` is the function programming the flash, called as :samp:`write(address, data)` (e.g. :samp:`fota.write_slot`); it is called with full pages only, except for the last one.
+        Two page buffers are used: while the writer thread programs one of them, the other one is filled by :meth:`write`.
+
+        If an :samp:`erase` function is given, called as :samp:`erase(address, length)` (e.g. :samp:`fota.erase_slot`), the flash is erased on demand one sector of :samp:`sector_size` bytes at a time:
+        each sector is erased before being written and, while the writer thread waits for data, up to :samp:`erase_ahead` sectors past the last written byte are erased in advance.
+        :samp:`address` must then be aligned to :samp:`sector_size` and :samp:`size` limits the erased area to the length of the data to be written.
+        When resuming an interrupted write, :samp:`address` may fall inside a sector: :samp:`erased` is then the address up to which the flash has already been erased (the :samp:`erased` attribute of the previous writer).
+
+    """
+
+    def __init__(self, address, write, page_size=512, erase=None, size=None, sector_size=4096, erase_ahead=1, erased=None):
+        self.address = address
+        self.page_size = page_size
+        self.written = 0
+        self._write = write
+        self._erase = erase
+        self._limit = None if size is None else address + size
+        self._sector_size = sector_size
+        self._erase_ahead = erase_ahead
+        self.erased = address if erased is None else max(address, erased)
+        self._bufs = [bytearray(page_size), bytearray(page_size)]
+        self._cur = 0
+        self._fill = 0
+        self._pending = None
+        self._error = None
+        self._stop = False
+        self._ready = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.start()
+
+    def _erase_to(self, end):
+        # erase whole sectors until end is covered, without going past the limit
+        if self._erase is None:
+            return
+        if self._limit is not None and end > self._limit:
+            end = self._limit
+        while self.erased < end:
+            n = self._sector_size
+            if self._limit is not None and self.erased + n > self._limit:
+                n = self._limit - self.erased
+            self._erase(self.erased, n)
+            self.erased += n
+
+    def _loop(self):
+        ahead = self._sector_size * self._erase_ahead
+        try:
+            self._erase_to(self.address + ahead)
+        except Exception as e:
+            self._error = e
+        while True:
+            self._ready.wait()
+            self._ready.clear()
+            pending = self._pending
+            self._pending = None
+            if pending is not None:
+                try:
+                    self._erase_to(pending[0] + len(pending[1]))
+                    self._write(pending[0], pending[1])
+                    self.written += len(pending[1])
+                except Exception as e:
+                    self._error = e
+            self._idle.set()
+            if self._stop:
+                self._done.set()
+                return
+            if pending is not None and self._error is None:
+                # erase the next sectors while the next page is being filled
+                try:
+                    self._erase_to(self.address + self.written + ahead)
+                except Exception as e:
+                    self._error = e
+
+    def _handoff(self, data):
+        # wait for the writer thread to release the other buffer, then pass it this one
+        self._idle.wait()
+        self._check()
+        self._idle.clear()
+        self._pending = (self.address + self.written, data)
+        self._ready.set()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, data):
+        """
+.. method:: write(data)
+
+        Append :samp:`data` to the stream. The call returns as soon as :samp:`data` has been buffered, waiting only if both page buffers are full.
+        Errors raised by the flash :samp:`write` function are raised again by the next call to :meth:`write` or :meth:`close`.
+
+        """
+        n = len(data)
+        i = 0
+        while i < n:
+            buf = self._bufs[self._cur]
+            k = min(n - i, self.page_size - self._fill)
+            buf[self._fill:self._fill + k] = data[i:i + k]
+            self._fill += k
+            i += k
+            if self._fill == self.page_size:
+                self._handoff(buf)
+                self._cur ^= 1
+                self._fill = 0
+
+    def flush(self):
+        """
+.. method:: flush()
+
+        Write the partially filled page, if any, and wait until every page has been programmed. The stream must not be written anymore after a partial page has been flushed.
+
+        """
+        if self._fill:
+            self._handoff(self._bufs[self._cur][:self._fill])
+            self._cur ^= 1
+            self._fill = 0
+        self._idle.wait()
+        self._check()
+
+    def close(self, flush=True):
+        """
+.. method:: close(flush=True)
+
+        Flush the data and stop the writer thread. Return the number of bytes written to flash.
+        If :samp:`flush` is False, the partially filled page is discarded instead, so that only full pages are written and the stream can be resumed later at address :samp:`address + written`.
+
+        """
+        try:
+            if flush:
+                self.flush()
+            else:
+                self._idle.wait()
+        finally:
+            self._stop = True
+            self._ready.set()
+            # the thread may still be erasing ahead
+            self._done.wait()
+        return self.written
@@ -19,6 +19,9 @@ The FOTA flow is quite simple:
         * :samp:`bc_size`, the length in bytes of the new firmware
         * :samp:`bc_url`, a https url to a S3 file containing the new firmware
 
+    * The job document can also contain the optional field :samp:`bc_compression`, set to :samp:`"lzss"` if the file at :samp:`bc_url` has been compressed with the
+      :samp:`benchmarks/lzss_compress.py` script (see :ref:`aws_iot_lzss`). The firmware is then decompressed while it is downloaded; :samp:`bc_size` and :samp:`bc_crc` refer to the decompressed firmware.
+
     * If the job can be performed, it is placed in the IN_PROGRESS status. Otherwise it is mared as FAILED and the flow stops.
     * The firmware is downloaded from :samp:`bc_url`, saved to the device and checked for errors against :samp:`bc_crc`
     * The device is restarted
@@ -58,17 +61,70 @@ import ssl
 import requests
 import mcu
 from aws.iot import jobs
+from aws.iot import md5
+from aws.iot import flashwriter
+from aws.iot import lzss
 
 next_bcaddr = 0
 bcsize = 0
 wsize = 0
+digest = None
+writer = None
+decoder = None
+checkpoint = None
+_dispatched = []
+_options = {"verify":True,"stream_md5":False,"erase_sector":0,"retries":3,"checkpoint_interval":16384,"checkpoint_cb":None}
 
 def _stream_cb(content):
-    global next_bcaddr
     global wsize
-    fota.write_slot(next_bcaddr+wsize,content)
+    if decoder is not None:
+        content = decoder.feed(content)
     wsize+=len(content)
+    if wsize>bcsize:
+        #the server ignored the Range request
+        raise ValueError
+    #pages are programmed by the writer thread while the next ones are downloaded
+    writer.write(content)
+
+def _program(addr, data):
+    #called by the writer thread: the digest covers exactly the bytes in flash
+    fota.write_slot(addr,data)
+    if digest is not None:
+        digest.update(data)
+    offset = addr+len(data)-next_bcaddr
+    #the state of the decompressor is not checkpointed: compressed downloads restart from zero
+    if decoder is None and len(data)==writer.page_size and offset-checkpoint["offset"]>=_options["checkpoint_interval"]:
+        _save_checkpoint(offset)
+
+def _save_checkpoint(offset):
+    checkpoint["offset"] = offset
+    checkpoint["md5"] = None if digest is None else digest.state()
+    checkpoint["erased"] = writer.erased-next_bcaddr
+    if _options["checkpoint_cb"] is not None:
+        _options["checkpoint_cb"](checkpoint)
+
+def _discard_checkpoint():
+    global checkpoint
+    checkpoint = None
+    if _options["checkpoint_cb"] is not None:
+        _options["checkpoint_cb"](None)
+
+def _can_resume(data):
+    #a checkpoint of the job firmware, restored after a reset
+    try:
+        return checkpoint is not None and checkpoint["offset"]>0 and checkpoint["crc"]==data["bc_crc"] and checkpoint["size"]==data["bc_size"] and is_fota_possible(data)
+    except Exception as e:
+        print(e)
+        return False
 
+def _check_crc(chk, crc):
+    if len(chk)*2!=len(crc):
+        return False
+    for i,b in enumerate(chk):
+        k = int(crc[i*2:i*2+2],16)
+        if k!=b:
+            return False
+    return True
 
 def is_fota_possible(data):
     try:
@@ -96,16 +152,73 @@ def is_fota_valid(data):
     return False
     
 
-def update(fota_data):
+def configure(verify=True, stream_md5=False, erase_sector=0, retries=3, checkpoint_interval=16384, checkpoint_cb=None):
+    """
+.. function:: configure(verify=True, stream_md5=False, erase_sector=0, retries=3, checkpoint_interval=16384, checkpoint_cb=None)
+
+    Set the default options of :ref:`update`, used also by :ref:`handle_fota_jobs`.
+
+    An interrupted download is retried up to :samp:`retries` times, resuming from the last checkpoint with an HTTP :samp:`Range` request.
+    A checkpoint (the number of bytes written to flash and, with :samp:`stream_md5`, the state of the MD5 computation) is taken every :samp:`checkpoint_interval` bytes and when the download fails.
+    If :samp:`checkpoint_cb` is given, it is called with the checkpoint dictionary each time one is taken, so that it can be persisted and restored with :ref:`resume` after a reset,
+    and with None once the checkpoint is no longer needed, because the download is complete or has been abandoned.
+    Checkpoints are mostly taken by the flash writer thread: :samp:`checkpoint_cb` should return quickly.
+
+    A FOTA job interrupted by a reset during the download is still IN_PROGRESS: if the checkpoint restored with :ref:`resume` matches the :samp:`bc_crc` and :samp:`bc_size` of the job document,
+    :ref:`handle_fota_jobs` and :ref:`handle_fota_job` resume its download instead of failing the job.
+
+    """
+    _options["verify"] = verify
+    _options["stream_md5"] = stream_md5
+    _options["erase_sector"] = erase_sector
+    _options["retries"] = retries
+    _options["checkpoint_interval"] = checkpoint_interval
+    _options["checkpoint_cb"] = checkpoint_cb
+
+def resume(saved):
+    """
+.. function:: resume(checkpoint)
+
+    Restore a :samp:`checkpoint` saved by the :samp:`checkpoint_cb` of :ref:`configure`. The next :ref:`update` of the same firmware continues the download from there.
+    It must be called before the ongoing FOTA job is handled, e.g. before the first call to :ref:`handle_fota_jobs`.
+
+    """
+    global checkpoint
+    checkpoint = saved
+
+def update(fota_data, verify=None, erase_sector=None, stream_md5=None):
     """
-.. function:: update(document)
+.. function:: update(document, verify=None, erase_sector=None, stream_md5=None)
 
     Given a correct job :samp:`document`, performs the FOTA update by downloading the correct firmware from the signed S3 bucket url
     and checking if the download was correct against the firmware CRC. Return True if the process finishes correctly.
+
+    If :samp:`verify` is True, the written slot is read back from flash and its MD5 is computed natively and checked against the CRC.
+    If :samp:`stream_md5` is True, the MD5 is also computed in Python while the pages are written and checked first: it spares the read back when :samp:`verify` is False, but it is much slower than the native
+    computation on most devices and it slows down flash writes, so it should be enabled only where measured faster. When both options are False the slot is read back anyway.
+
+    If :samp:`erase_sector` is the flash sector size in bytes, sectors are erased one at a time just ahead of the downloaded data, instead of erasing the whole slot before the download starts:
+    the connection is not left idle during a long erase and the download begins immediately.
+    Options set to None take the values set by :ref:`configure`.
+
+    Interrupted downloads are resumed from the last checkpoint (see :ref:`configure`), also across calls to :samp:`update` for the same firmware.
     
     """
     global next_bcaddr
     global bcsize
+    global wsize
+    global digest
+    global writer
+    global decoder
+    global checkpoint
+    if verify is None:
+        verify = _options["verify"]
+    if stream_md5 is None:
+        stream_md5 = _options["stream_md5"]
+    if not stream_md5:
+        verify = True
+    if erase_sector is None:
+        erase_sector = _options["erase_sector"]
     # setup 
     awscert = __lookup(BALTIMORE_CYBERTRUST_ROOT)
     ctx = ssl.create_ssl_context(cacert=awscert,options=ssl.CERT_REQUIRED|ssl.SERVER_AUTH)
@@ -115,19 +228,67 @@ def update(fota_data):
     #prepare for FOTA
     next_bcaddr = fota.find_bytecode_slot()
     bcsize = fota_data["bc_size"]
-    fota.erase_slot(next_bcaddr, bcsize)
+    crc = fota_data["bc_crc"]
+    compression = None
+    if "bc_compression" in fota_data:
+        compression = fota_data["bc_compression"]
+    if compression is not None and compression!="lzss":
+        print("Unsupported compression",compression)
+        return False
+    if checkpoint is not None and (compression is not None or (stream_md5 and checkpoint["offset"] and checkpoint["md5"] is None) or checkpoint["crc"]!=crc or checkpoint["addr"]!=next_bcaddr or checkpoint["size"]!=bcsize):
+        #checkpoint of another firmware, or taken without the digest state now needed
+        checkpoint = None
     
     url = fota_data["bc_url"]
-    rr = requests.get(url, ctx=ctx, stream_callback=_stream_cb, stream_chunk=chunk)
-    if wsize!=bcsize:
-        return False
-    chk = fota.checksum_slot(next_bcaddr,bcsize)
-    fota.close_slot(next_bcaddr)
-    for i,b in enumerate(chk):
-        k = int(fota_data["bc_crc"][i*2:i*2+2],16)
-        if k!=b:
-            print("Bad crc!")
+    attempt = 0
+    while True:
+        if checkpoint is None:
+            checkpoint = {"crc":crc,"addr":next_bcaddr,"size":bcsize,"offset":0,"md5":None,"erased":0}
+            if not erase_sector:
+                fota.erase_slot(next_bcaddr, bcsize)
+                checkpoint["erased"] = bcsize
+        offset = checkpoint["offset"]
+        wsize = offset
+        digest = md5.MD5(checkpoint["md5"]) if stream_md5 else None
+        decoder = None if compression is None else lzss.Decoder()
+        erased = next_bcaddr+checkpoint["erased"]
+        if erase_sector:
+            writer = flashwriter.SlotWriter(next_bcaddr+offset, _program, chunk, erase=fota.erase_slot, size=bcsize-offset, sector_size=erase_sector, erased=erased)
+        else:
+            writer = flashwriter.SlotWriter(next_bcaddr+offset, _program, chunk, erased=erased)
+        headers = {}
+        if offset:
+            print("Resuming download from",offset)
+            headers["Range"] = "bytes="+str(offset)+"-"
+        status = None
+        try:
+            rr = requests.get(url, headers=headers, ctx=ctx, stream_callback=_stream_cb, stream_chunk=chunk)
+            status = rr.status
+        except Exception as e:
+            print(e)
+        if (status==200 or status==206) and wsize==bcsize:
+            writer.close()
             break
+        #keep the full pages written so far and retry from there
+        writer.close(False)
+        if decoder is not None or wsize>bcsize or (status is not None and status!=200 and status!=206 and writer.written):
+            #flash holds data not belonging to the firmware, start over
+            checkpoint = None
+        elif status is None or status==200 or status==206:
+            _save_checkpoint(offset+writer.written)
+        attempt += 1
+        if attempt>_options["retries"]:
+            return False
+        sleep(1000*attempt)
+
+    fota.close_slot(next_bcaddr)
+    _discard_checkpoint()
+    if digest is not None and not _check_crc(digest.digest(),crc):
+        print("Bad crc!")
+        return False
+    if verify and not _check_crc(fota.checksum_slot(next_bcaddr,bcsize),crc):
+        print("Bad crc in flash!")
+        return False
 
     return True
 
@@ -162,9 +323,131 @@ def reset():
 
 
 
-def handle_fota_jobs(jbs,force=False,disconnect_mqtt=True,auto_reset=True,job_cbk=None):
+def _confirm_fota_job(job,auto_reset):
+    print("Job asks for FOTA confirmation of bytecode slot",job.document["bc_idx"])
+    if is_fota_valid(job.document):
+        confirm()
+        print("Job SUCCEEDED")
+        job.update(jobs.Job.SUCCEEDED)
+    else:
+        print("Job FAILED")
+        job.update(jobs.Job.FAILED,{"reason":"invalid fota"})
+    if auto_reset:
+        reset()
+    return True
+
+def _start_fota_job(job,disconnect_mqtt,auto_reset):
+    print("Job asks for FOTA of bytecode to slot",job.document["bc_idx"])
+    if not is_fota_possible(job.document):
+        print("Job FAILED")
+        job.update(jobs.Job.FAILED,{"reason":"bad fota data"})
+        return False
+    #fota document makes sense, go on
+    print("Job IN PROGRESS")
+    #mark the job, so that after reset it is recognized as an ongoing fota
+    job.update(jobs.Job.IN_PROGRESS,{"fota":"download"})
+    return _download_fota(job,disconnect_mqtt,auto_reset)
+
+def _resume_fota_job(job,disconnect_mqtt,auto_reset):
+    #an ongoing fota job: resume its download interrupted by a reset, or confirm the new firmware
+    if not is_fota_valid(job.document) and _can_resume(job.document):
+        print("Job resumes FOTA download from",checkpoint["offset"])
+        return _download_fota(job,disconnect_mqtt,auto_reset)
+    return _confirm_fota_job(job,auto_reset)
+
+def _download_fota(job,disconnect_mqtt,auto_reset):
+    if disconnect_mqtt:
+        #disconnect mqtt
+        job.thing.mqtt.disconnect()
+        job.thing.mqtt.close()
+    #perform fota
+    print("Downloading firmware...")
+    ret = update(job.document)
+    if ret:
+        #let's test new firmware!
+        #it must reboot and finalize the in progress fota job
+        print("Firmware written correctly")
+        test(job.document)
+    else:
+        #don't call test()
+        #device will reset and fail the ongoing job, instead of resuming the download
+        _discard_checkpoint()
+        print("Firmware not correctly written. Job will FAIL on reset")
+    #signal reset!
+    if auto_reset:
+        reset()
+    return True
+
+def _is_fota_job(job):
+    return type(job.document) == PDICT and job.document.get("operation")=="fota"
+
+def handle_fota_job(job,disconnect_mqtt=True,auto_reset=True):
+    """
+.. function:: handle_fota_job(job,disconnect_mqtt=True,auto_reset=True)
+
+    Handle a single described FOTA :samp:`job`: a queued job starts the firmware update, while an ongoing one confirms or fails the firmware running after the update,
+    or resumes a download interrupted by a reset (see :ref:`configure`).
+    The :samp:`disconnect_mqtt` and :samp:`auto_reset` arguments have the same meaning as in :ref:`handle_fota_jobs`.
+
+    The function can be registered as the :samp:`"fota"` operation handler of a Jobs instance, so that FOTA jobs are executed as soon as they are notified::
+
+        myjobs.on_operation("fota", awsfota.handle_fota_job)
+
+    Return True if a reset is needed.
+
+    """
+    if job.status==jobs.Job.IN_PROGRESS:
+        return _resume_fota_job(job,disconnect_mqtt,auto_reset)
+    return _start_fota_job(job,disconnect_mqtt,auto_reset)
+
+def _handle_other_job(job,job_cbk,executor):
+    #non-FOTA job, return True if it has been handed over
+    if executor is not None:
+        executor.submit(job)
+        return True
+    if job_cbk is not None:
+        job.thing._dispatch("job_cbk:"+job.jobid,job_cbk,job)
+        return True
+    return False
+
+def _pending_jobs(jbs):
+    #list pending jobs and forget the ones passed to job_cbk that are no longer pending
+    global _dispatched
+    ongoing,queued = jbs.list()
+    if ongoing or queued:
+        pending = [job.jobid for job in ongoing]+[job.jobid for job in queued]
+        _dispatched = [jobid for jobid in _dispatched if jobid in pending]
+    return ongoing,queued
+
+def _skip_job(job,seen,executor):
+    return job.jobid in seen or job.jobid in _dispatched or (executor is not None and executor.busy(job.jobid))
+
+def _scan_fota_jobs(jbs,seen,disconnect_mqtt,auto_reset,job_cbk,executor,fota_only=False):
+    ongoing,queued = _pending_jobs(jbs)
+    #describe the jobs not being handled already, in a single round trip
+    ongoing = jbs.describe_all([job for job in ongoing if not _skip_job(job,seen,executor)])
+    queued = jbs.describe_all([job for job in queued if not _skip_job(job,seen,executor)])
+
+    #handle ongoing jobs
+    for job in ongoing:
+        print("Checking ongoing job",job)
+        if _is_fota_job(job):
+            return _resume_fota_job(job,disconnect_mqtt,auto_reset)
+        elif not fota_only:
+            _handle_other_job(job,job_cbk,executor)
+
+    #handle queued jobs
+    for job in queued:
+        print("Checking queued job",job)
+        if _is_fota_job(job):
+            if _start_fota_job(job,disconnect_mqtt,auto_reset):
+                return True
+        elif not fota_only:
+            _handle_other_job(job,job_cbk,executor)
+
+def handle_fota_jobs(jbs,force=False,disconnect_mqtt=True,auto_reset=True,job_cbk=None,executor=None):
     """
-.. function:: handle_fota_jobs(jobs,force=False,disconnect_mqtt=True,auto_reset=True,job_cbk=None)
+.. function:: handle_fota_jobs(jobs,force=False,disconnect_mqtt=True,auto_reset=True,job_cbk=None,executor=None)
 
     The entire FOTA flow can be implemented by adding this function to an AWS ready firmware.
     
@@ -174,73 +457,43 @@ def handle_fota_jobs(jbs,force=False,disconnect_mqtt=True,auto_reset=True,job_cb
     * :samp:`force`, if True forces the retrieval of pending and queued jobs regardless of a mqtt notification of the new jobs event
     * :samp:`disconnect_mqtt`, determines if th mqtt connection of the current Thing is closed before attempting a FOTA. By default it is set to True since keeping two TLS sockets open (one to the MQTT broker and the other to the S3 bucket) can be demanding for most devices.
     * :samp:`auto_reset`, automatically resets the device when the FOTA flow requires it. By default is set to True, however it can be disabled and the needed reset can be performed manually. A reset is signaled by :ref:`handle_fota_jobs` returning True.
-    * :samp:`job_cbk`, is the job callback. Each non-FOTA job is passed to :samp:`job_cbk` for external handling if :samp:`job_cbk` is not None
+    * :samp:`job_cbk`, is the job callback. Each non-FOTA job is passed to :samp:`job_cbk` for external handling if :samp:`job_cbk` is not None. If the Thing has a dispatcher (see :meth:`Thing.set_dispatcher`), the callback runs in the dispatcher pool.
+    * :samp:`executor`, is a :class:`JobExecutor` (module aws.iot.jobs). If given, every pending non-FOTA job is submitted to it instead of :samp:`job_cbk`, running in parallel with automatic status transitions.
 
     The function must be called at least twice: the first time, right after the connection to the mqtt broker with :samp:`force=True` in order to handle all pending jobs. The second call can be made periodically in the publish loop to catch new queued jobs.
 
+    When only :samp:`job_cbk` is given, jobs are acquired with :meth:`Jobs.start_next`, which returns the next pending job together with its document and places it IN_PROGRESS in a single round trip.
+    Non-FOTA jobs are therefore already IN_PROGRESS when passed to :samp:`job_cbk`, and each of them is passed only once. While the next pending job is one already passed to :samp:`job_cbk`,
+    pending jobs are listed instead, so that FOTA jobs queued behind it are not delayed.
+    Otherwise, pending jobs are retrieved with :meth:`Jobs.list` and described with :meth:`Jobs.describe_all`: non-FOTA jobs are submitted to :samp:`executor`, which places them IN_PROGRESS by itself,
+    or left untouched if there is no :samp:`executor`.
+
     """
     if not jbs.changed() and not force: 
         return
-    ongoing,queued = jbs.list()
-    
-    if ongoing:
-        #handle ongoing jobs
-        for job in ongoing:
-            print("Checking ongoing job",job)
-            ret = job.describe()
-            if ret and job.document["operation"]=="fota":
-                print("Job asks for FOTA confirmation of bytecode slot",job.document["bc_idx"])
-                if is_fota_valid(job.document):
-                    confirm()
-                    print("Job SUCCEEDED")
-                    job.update(jobs.Job.SUCCEEDED)
-                else:
-                    print("Job FAILED")
-                    job.update(jobs.Job.FAILED,{"reason":"invalid fota"})
-                if auto_reset:
-                    reset()
-                return True
-            elif ret and job_cbk is not None:
-                job_cbk(job)
-
-    
-    if queued:
-        #handle queued jobs
-        for job in queued:
-            print("Checking queued job",job)
-            ret = job.describe()
-            if ret and job.document["operation"]=="fota":
-                print("Job asks for FOTA of bytecode to slot",job.document["bc_idx"])
-                if not is_fota_possible(job.document):
-                    print("Job FAILED")
-                    job.update(jobs.Job.FAILED,{"reason":"bad fota data"})
-                    continue
-                #fota document makes sense, go on
-                print("Job IN PROGRESS")
-                job.update(jobs.Job.IN_PROGRESS)
-                if disconnect_mqtt:
-                    #disconnect mqtt
-                    job.thing.mqtt.disconnect()
-                    job.thing.mqtt.close()
-                #perform fota
-                print("Downloading firmware...")
-                ret = update(job.document)
-                if ret:
-                    #let's test new firmware!
-                    #it must reboot and finalize the in progress fota job
-                    print("Firmware written correctly")
-                    test(job.document)
-                else:
-                    #don't call test()
-                    #device will reset and fail the ongoing job
-                    print("Firmware not correctly written. Job will FAIL on reset")
-                #signal reset!
-                if auto_reset:
-                    reset()
+    if job_cbk is None or executor is not None:
+        #the executor starts its jobs by itself, and without it nobody would handle non-FOTA jobs
+        return _scan_fota_jobs(jbs,[],disconnect_mqtt,auto_reset,job_cbk,executor)
+    seen = []
+    while True:
+        job = jbs.start_next()
+        if job is None:
+            return
+        if _skip_job(job,seen,None):
+            #the next pending job is still being handled: look for the FOTA jobs behind it
+            return _scan_fota_jobs(jbs,seen,disconnect_mqtt,auto_reset,job_cbk,None,True)
+        seen.append(job.jobid)
+        print("Checking next job",job)
+        if _is_fota_job(job):
+            #start-next reports every job as IN_PROGRESS: only the marker set by
+            #_start_fota_job tells a download already started from a job just started
+            if type(job.status_details)==PDICT and job.status_details.get("fota")=="download":
+                return _resume_fota_job(job,disconnect_mqtt,auto_reset)
+            if _start_fota_job(job,disconnect_mqtt,auto_reset):
                 return True
-            elif ret and job_cbk:
-                job_cbk(job)
-
-
-    
-
+        else:
+            _handle_other_job(job,job_cbk,None)
+            _dispatched.append(job.jobid)
+            if len(_dispatched)>8:
+                #jobs completed by job_cbk are only forgotten when listed
+                _pending_jobs(jbs)
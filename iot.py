@@ -28,6 +28,8 @@ Check this video for a live demo:
 
 import json
 import ssl
+import threading
+import timers
 #-if AWSCLOUD_LWMQTT
 from lwmqtt import mqtt
 #-else
@@ -35,6 +37,7 @@ from mqtt import mqtt
 #-endif
 
 import mcu
+from aws.iot import jsonscan
 
 legacy_and_amazon_cas = '''-----BEGIN CERTIFICATE-----
 MIIE0zCCA7ugAwIBAgIQGNrRniZ96LtKIVjNzGs7SjANBgkqhkiG9w0BAQUFADCB
@@ -87,23 +90,1225 @@ rqXRfboQnoZsG4q5WTP468SQvvG5
 \x00'''
 
 
+class _Batcher():
+
+    def __init__(self, client, max_size, max_latency, max_buffer, topics):
+        self.client = client
+        self.max_size = max_size
+        self.max_latency = max_latency
+        self.max_buffer = max_buffer
+        self.topics = topics
+        self.buffers = {}
+        self.buffered = 0
+        self.lock = threading.Lock()
+        self.running = True
+        threading.Thread(target=self._flush_loop).start()
+
+    def accepts(self, topic):
+        if self.topics is None:
+            # internal AWS topics (shadow, jobs) are never batched
+            return not topic.startswith('$aws/')
+        return topic in self.topics
+
+    def add(self, topic, payload):
+        size = len(payload) + 1
+        if size + 1 > self.max_size:
+            # too big to be batched: preserve ordering and send it alone
+            self.flush(topic)
+            self.client._send(topic, payload)
+            return
+        if self.buffered + size > self.max_buffer:
+            # back-pressure: the caller pays for flushing the oldest batch
+            self.flush(self._oldest())
+        self.lock.acquire()
+        if topic not in self.buffers:
+            self.buffers[topic] = [[], 1, timers.now()]
+        buf = self.buffers[topic]
+        full = buf[1] + size > self.max_size
+        if not full:
+            buf[0].append(payload)
+            buf[1] += size
+            self.buffered += size
+        self.lock.release()
+        if full:
+            self.flush(topic)
+            self.add(topic, payload)
+
+    def _oldest(self):
+        self.lock.acquire()
+        oldest = None
+        ts = 0
+        for topic in self.buffers:
+            if oldest is None or self.buffers[topic][2] < ts:
+                oldest = topic
+                ts = self.buffers[topic][2]
+        self.lock.release()
+        return oldest
+
+    def _take(self, topic):
+        self.lock.acquire()
+        buf = None
+        if topic in self.buffers:
+            buf = self.buffers.pop(topic)
+            self.buffered -= buf[1] - 1
+        self.lock.release()
+        return buf
+
+    def flush(self, topic=None):
+        if topic is None:
+            self.lock.acquire()
+            topics = [t for t in self.buffers]
+            self.lock.release()
+        else:
+            topics = [topic]
+        for topic in topics:
+            buf = self._take(topic)
+            if buf is not None and buf[0]:
+                self.client._send(topic, '[' + ','.join(buf[0]) + ']')
+
+    def _flush_loop(self):
+        tick = max(self.max_latency // 4, 20)
+        while self.running:
+            sleep(tick)
+            now = timers.now()
+            expired = []
+            self.lock.acquire()
+            for topic in self.buffers:
+                if now - self.buffers[topic][2] >= self.max_latency:
+                    expired.append(topic)
+            self.lock.release()
+            for topic in expired:
+                try:
+                    self.flush(topic)
+                except Exception as e:
+                    print(e)
+
+
+class _Spool():
+    # ring buffer of [topic, payload, qos] messages kept while offline, with
+    # an optional file segment holding the oldest ones
+
+    def __init__(self, client, size, policy, rate, path, file_size):
+        self.client = client
+        self.size = size
+        self.policy = policy
+        self.rate = rate
+        self.path = path
+        self.file_size = file_size
+        self.in_file = 0
+        self.file_sent = 0
+        self.items = []
+        self.lock = threading.Lock()
+        self.online = True
+        self.replaying = False
+        self.spooled = 0
+        self.dropped = 0
+        self.replayed = 0
+
+    def holding(self):
+        # new messages must be spooled to keep ordering until the spool is empty
+        return not self.online or self.replaying or self.items or self.in_file
+
+    def add(self, topic, payload, qos):
+        self.lock.acquire()
+        self.spooled += 1
+        if len(self.items) >= self.size:
+            if self.path is not None and not self.replaying and self.in_file < self.file_size:
+                self._to_file(self.items.pop(0))
+            elif self.policy == AWSMQTTClient.DROP_NEWEST:
+                self.dropped += 1
+                topic = None
+            elif self.policy == AWSMQTTClient.SAMPLE:
+                # halve the density of the spooled samples
+                kept = self.items[1::2]
+                self.dropped += len(self.items) - len(kept)
+                self.items = kept
+            else:
+                self.items.pop(0)
+                self.dropped += 1
+        if topic is not None:
+            self.items.append([topic, payload, qos])
+        # the replay may have ended after the caller checked holding(): restart it,
+        # otherwise the spool would hold every message until the next reconnection
+        start = self.online and not self.replaying
+        if start:
+            self.replaying = True
+        self.lock.release()
+        if start:
+            threading.Thread(target=self._replay_loop).start()
+
+    def _to_file(self, item):
+        try:
+            f = open(self.path, 'a')
+            f.write(json.dumps(item) + '\n')
+            f.close()
+            self.in_file += 1
+        except Exception as e:
+            self.dropped += 1
+
+    def replay(self):
+        self.lock.acquire()
+        self.online = True
+        start = not self.replaying and (self.items or self.in_file)
+        if start:
+            self.replaying = True
+        self.lock.release()
+        if start:
+            threading.Thread(target=self._replay_loop).start()
+
+    def _replay_loop(self):
+        period = 1000 // self.rate if self.rate else 0
+        try:
+            if self.in_file and not self._replay_file(period):
+                self.replaying = False
+                return
+            while self.online:
+                self.lock.acquire()
+                if not self.items:
+                    self.replaying = False
+                    self.lock.release()
+                    return
+                item = self.items.pop(0)
+                self.lock.release()
+                if not self._resend(item, period):
+                    self.lock.acquire()
+                    self.items.insert(0, item)
+                    self.lock.release()
+                    break
+        except Exception as e:
+            print(e)
+        self.replaying = False
+
+    def _replay_file(self, period):
+        f = open(self.path)
+        idx = 0
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            idx += 1
+            if idx <= self.file_sent:
+                continue
+            if not self._resend(json.loads(line), period):
+                # keep the file, messages already sent are skipped next time
+                f.close()
+                return False
+            self.file_sent += 1
+        f.close()
+        f = open(self.path, 'w')
+        f.close()
+        self.in_file = 0
+        self.file_sent = 0
+        return True
+
+    def _resend(self, item, period):
+        if not self.online:
+            return False
+        if self.client._limiter is not None:
+            self.client._limiter.wait(len(item[1]) if item[1] else 0, item[0].startswith('$aws/'))
+        try:
+            mqtt.Client.publish(self.client, item[0], item[1], item[2])
+        except Exception as e:
+            self.online = False
+            return False
+        self.replayed += 1
+        if period:
+            sleep(period)
+        return True
+
+    def stats(self):
+        return {'spooled': self.spooled, 'dropped': self.dropped, 'replayed': self.replayed, 'pending': len(self.items) + self.in_file - self.file_sent}
+
+
+class _Limiter():
+    # message and byte token buckets, each [rate per second, capacity, tokens,
+    # 1 if it counts messages or 0 if it counts payload bytes];
+    # low priority traffic can't use the last reserve percent of the tokens
+
+    def __init__(self, client, msg_rate, byte_rate, burst, mode, reserve, queue_size):
+        self.client = client
+        self.queue_size = queue_size
+        self.buckets = []
+        if msg_rate:
+            self.buckets.append([msg_rate, msg_rate * burst // 1000, msg_rate * burst // 1000, 1])
+        if byte_rate:
+            self.buckets.append([byte_rate, byte_rate * burst // 1000, byte_rate * burst // 1000, 0])
+        self.mode = mode
+        self.reserve = reserve
+        self.ts = timers.now()
+        self.lock = threading.Lock()
+        self.queues = [[], []]
+        self.draining = False
+
+    def _need(self, bucket, nbytes):
+        # messages bucket counts 1 per message, bytes bucket the payload size
+        return 1 if bucket[3] else nbytes
+
+    def _refill(self):
+        now = timers.now()
+        elapsed = now - self.ts
+        if elapsed <= 0:
+            return
+        self.ts = now
+        for bucket in self.buckets:
+            bucket[2] = min(bucket[1], bucket[2] + bucket[0] * elapsed / 1000)
+
+    def take(self, nbytes, high):
+        # return 0 if tokens have been taken, otherwise the milliseconds to wait
+        self.lock.acquire()
+        self._refill()
+        wait = 0
+        for bucket in self.buckets:
+            need = self._need(bucket, nbytes)
+            if not high:
+                need += bucket[1] * self.reserve / 100
+            # a message bigger than the bucket can only be sent with a full bucket
+            need = min(need, bucket[1])
+            if bucket[2] < need:
+                wait = max(wait, int((need - bucket[2]) * 1000 / bucket[0]) + 1)
+        if not wait:
+            for bucket in self.buckets:
+                bucket[2] -= self._need(bucket, nbytes)
+        self.lock.release()
+        return wait
+
+    def wait(self, nbytes, high):
+        while True:
+            wait = self.take(nbytes, high)
+            if not wait:
+                return
+            sleep(wait)
+
+    def admit(self, topic, payload, qos):
+        # return True if the message can be sent now, False if it must be
+        # rejected (also when the queue is full), None if it has been queued
+        high = topic.startswith('$aws/')
+        nbytes = len(payload) if payload else 0
+        if self.mode == AWSMQTTClient.BLOCK:
+            self.wait(nbytes, high)
+            return True
+        if self.mode == AWSMQTTClient.QUEUE:
+            queue = self.queues[0 if high else 1]
+            if not queue and not self.take(nbytes, high):
+                return True
+            self.lock.acquire()
+            if len(self.queues[0]) + len(self.queues[1]) >= self.queue_size:
+                self.lock.release()
+                return False
+            queue.append([topic, payload, qos])
+            start = not self.draining
+            self.draining = True
+            self.lock.release()
+            if start:
+                threading.Thread(target=self._drain).start()
+            return None
+        return not self.take(nbytes, high)
+
+    def _drain(self):
+        while True:
+            self.lock.acquire()
+            if self.queues[0]:
+                item = self.queues[0].pop(0)
+            elif self.queues[1]:
+                item = self.queues[1].pop(0)
+            else:
+                self.draining = False
+                self.lock.release()
+                return
+            self.lock.release()
+            try:
+                self.client._send(item[0], item[1], item[2])
+            except Exception as e:
+                print(e)
+
+
 class AWSMQTTClient(mqtt.Client):
+    DROP_OLDEST = 0
+    DROP_NEWEST = 1
+    SAMPLE = 2
+    BLOCK = 0
+    NONBLOCK = 1
+    QUEUE = 2
 
-    def __init__(self, mqtt_id, endpoint, ssl_ctx):
-        mqtt.Client.__init__(self, mqtt_id, clean_session=True)
+    def __init__(self, mqtt_id, endpoint, ssl_ctx, clean_session=True):
+        mqtt.Client.__init__(self, mqtt_id, clean_session=clean_session)
+        self.clean_session = clean_session
         self.endpoint = endpoint
         self.ssl_ctx = ssl_ctx
+        self._batcher = None
+        self._aconnect_cb = None
+        self._connect_hooks = []
+        self._inflight = {}
+        self._inflight_window = 8
+        self._inflight_used = 0
+        self._early_acks = []
+        self._inflight_lock = threading.Lock()
+        self._inflight_free = threading.Event()
+        self._inflight_free.set()
+        self._puback = False
+        self._spool = None
+        self._limiter = None
+        self._breconnect_cb = None
+        self._backoff_base = 1000
+        self._backoff_cap = 60000
+        self._attempts = 0
 #-if AWSCLOUD_LWMQTT
     def connect(self, port=8883, sock_keepalive=None, aconnect_cb=None, breconnect_cb=None, loop_failure=None):
-        mqtt.Client.connect(self, self.endpoint, 60, port=port, ssl_ctx=self.ssl_ctx, sock_keepalive=sock_keepalive, aconnect_cb=aconnect_cb, breconnect_cb=breconnect_cb, loop_failure=loop_failure)
+        self._aconnect_cb = aconnect_cb
+        self._breconnect_cb = breconnect_cb
+        mqtt.Client.connect(self, self.endpoint, 60, port=port, ssl_ctx=self.ssl_ctx, sock_keepalive=sock_keepalive, aconnect_cb=self._after_connect, breconnect_cb=self._before_reconnect, loop_failure=loop_failure)
 #-else
     def connect(self, port=8883, sock_keepalive=None, aconnect_cb=None, breconnect_cb=None):
-        mqtt.Client.connect(self, self.endpoint, 60, port=port, ssl_ctx=self.ssl_ctx, sock_keepalive=sock_keepalive, aconnect_cb=aconnect_cb, breconnect_cb=breconnect_cb)
+        self._aconnect_cb = aconnect_cb
+        self._breconnect_cb = breconnect_cb
+        mqtt.Client.connect(self, self.endpoint, 60, port=port, ssl_ctx=self.ssl_ctx, sock_keepalive=sock_keepalive, aconnect_cb=self._after_connect, breconnect_cb=self._before_reconnect)
 #-endif
-    def publish(self, topic, payload=None):
+
+    def set_reconnect_backoff(self, base=1000, cap=60000):
+        """
+.. method:: set_reconnect_backoff(base=1000, cap=60000)
+
+        Before each reconnection attempt the client waits a random delay between 0 and :samp:`base` * 2^n milliseconds, n being the number of failed attempts, up to :samp:`cap` milliseconds.
+        The random jitter spreads the reconnections of many devices dropped by the same broker event, avoiding a reconnect storm. A :samp:`base` of 0 disables the delay.
+
+        """
+        self._backoff_base = base
+        self._backoff_cap = cap
+
+    def _before_reconnect(self, client):
+        if self._backoff_base:
+            delay = self._backoff_base << min(self._attempts, 16)
+            self._attempts += 1
+            sleep(random(0, min(delay, self._backoff_cap)))
+        if self._breconnect_cb is not None:
+            self._breconnect_cb(client)
+
+    def _after_connect(self, client):
+        self._attempts = 0
+        # internal hooks run before the user callback
+        for hook in self._connect_hooks:
+            try:
+                hook()
+            except Exception as e:
+                print(e)
+        if self._aconnect_cb is not None:
+            self._aconnect_cb(client)
+
+    def publish(self, topic, payload=None, qos=0, callback=None):
+        """
+.. method:: publish(topic, payload=None, qos=0, callback=None)
+
+        Publish :samp:`payload` to :samp:`topic`. Dictionaries are JSON encoded.
+        Return False if the message has been rejected by the rate limiter (see :meth:`set_rate_limit`), True otherwise.
+
+        With :samp:`qos` 1, the message is sent without waiting for its PUBACK and a :class:`Request` is returned, resolved (and passed to :samp:`callback`, if given) when the PUBACK is received.
+        None is returned instead when the message has been spooled (see :meth:`enable_spool`) or queued by the rate limiter, since its PUBACK is not tracked.
+        Up to the in-flight window (see :meth:`set_inflight_window`) messages can be waiting for their PUBACK at the same time: when the window is full, publish blocks until a slot is freed.
+        Messages still unacknowledged when the connection drops are retransmitted after reconnection; if the retransmission itself fails, their requests are resolved as not accepted::
+
+            reqs = [my_thing.mqtt.publish('dev/sample', {'asample': i}, qos=1) for i in range(4)]
+            for req in reqs:
+                req.wait(5000)
+
+        """
         if type(payload) == PDICT:
             payload = json.dumps(payload)
-        mqtt.Client.publish(self, topic, payload)
+        if self._batcher is not None and not qos and self._batcher.accepts(topic):
+            self._batcher.add(topic, payload)
+            return True
+        if self._limiter is not None:
+            admitted = self._limiter.admit(topic, payload, qos)
+            if admitted is None:
+                # queued: like spooled messages, QoS 1 ones are not tracked
+                return None if qos else True
+            if not admitted:
+                return False
+        if qos:
+            return self._publish_qos1(topic, payload, callback)
+        self._send(topic, payload, 0, False)
+        return True
+
+    def _send(self, topic, payload, qos=0, limit=True):
+        # return False if the message has been spooled
+        if limit and self._limiter is not None:
+            self._limiter.wait(len(payload) if payload else 0, topic.startswith('$aws/'))
+        spool = self._spool
+        if spool is None:
+            return mqtt.Client.publish(self, topic, payload, qos)
+        if not spool.holding():
+            try:
+                return mqtt.Client.publish(self, topic, payload, qos)
+            except Exception as e:
+                spool.online = False
+        spool.add(topic, payload, qos)
+        return False
+
+    def set_rate_limit(self, msg_rate=100, byte_rate=524288, burst=1000, mode=0, reserve=25, queue_size=16):
+        """
+.. method:: set_rate_limit(msg_rate=100, byte_rate=524288, burst=1000, mode=AWSMQTTClient.BLOCK, reserve=25, queue_size=16)
+
+        Limit outbound traffic to stay within the AWS IoT per-connection quotas: at most :samp:`msg_rate` messages per second and :samp:`byte_rate` payload bytes per second (None disables a limit),
+        allowing bursts of :samp:`burst` milliseconds worth of traffic. The limit applies to every message sent by the client, including batches, retransmissions and replayed messages.
+
+        Shadow and jobs traffic (topics starting with :samp:`$aws/`) has priority over other messages: telemetry can't use the last :samp:`reserve` percent of the available budget, which is kept for control traffic.
+
+        When the budget is exhausted, :samp:`mode` decides how :meth:`publish` behaves:
+
+        * :samp:`AWSMQTTClient.BLOCK`, it waits for enough budget;
+        * :samp:`AWSMQTTClient.NONBLOCK`, it returns False without sending the message;
+        * :samp:`AWSMQTTClient.QUEUE`, the message is queued and sent by a background thread as soon as possible, control traffic first. At most :samp:`queue_size` messages are queued: when the queue is full, publish returns False.
+          QoS 1 messages sent this way are not tracked and publish returns None for them, as for messages spooled while offline.
+
+        """
+        self._limiter = _Limiter(self, msg_rate, byte_rate, burst, mode, reserve, queue_size)
+
+    def enable_spool(self, size=32, policy=0, rate=5, path=None, file_size=256):
+        """
+.. method:: enable_spool(size=32, policy=AWSMQTTClient.DROP_OLDEST, rate=5, path=None, file_size=256)
+
+        Enable store-and-forward of outbound messages. When publishing fails because the connection is down, messages are kept in a ring buffer of :samp:`size` messages
+        and, once the client reconnects, they are sent again in order at most :samp:`rate` messages per second (0 means as fast as possible), so that the burst does not trip AWS throttling.
+        Messages published while the spool is being replayed are queued behind the spooled ones.
+
+        If :samp:`path` is given, messages that don't fit in memory are moved to a file segment at :samp:`path` holding up to :samp:`file_size` messages.
+        When everything is full, :samp:`policy` decides what to drop:
+
+        * :samp:`AWSMQTTClient.DROP_OLDEST`, the oldest message in memory;
+        * :samp:`AWSMQTTClient.DROP_NEWEST`, the message being published;
+        * :samp:`AWSMQTTClient.SAMPLE`, every other message in memory, halving the sampling rate of the spooled data.
+
+        Spooled QoS 1 messages are sent again with QoS 1, but their PUBACK is not tracked. See :meth:`spool_stats` for counters.
+
+        """
+        self._spool = _Spool(self, size, policy, rate, path, file_size)
+        if self._spool_hook not in self._connect_hooks:
+            self._connect_hooks.append(self._spool_hook)
+
+    def _spool_hook(self):
+        if self._spool is not None:
+            self._spool.replay()
+
+    def spool_stats(self):
+        """
+.. method:: spool_stats()
+
+        Return a dictionary with the number of :samp:`spooled`, :samp:`dropped` and :samp:`replayed` messages and the number of messages still :samp:`pending` in the spool.
+
+        """
+        if self._spool is None:
+            return None
+        return self._spool.stats()
+
+    def set_inflight_window(self, window):
+        """
+.. method:: set_inflight_window(window)
+
+        Set to :samp:`window` the maximum number of QoS 1 messages waiting for their PUBACK (8 by default).
+
+        """
+        self._inflight_window = window
+        self._inflight_free.set()
+
+    def _publish_qos1(self, topic, payload, callback):
+#-if !AWSCLOUD_LWMQTT
+        if not self._puback:
+            self._puback = True
+            self._connect_hooks.append(self._retransmit)
+            self.on(mqtt.PUBACK, self._handle_puback)
+#-endif
+        # wait for a free slot in the in-flight window
+        while True:
+            self._inflight_lock.acquire()
+            if self._inflight_used < self._inflight_window:
+                break
+            self._inflight_free.clear()
+            self._inflight_lock.release()
+            self._inflight_free.wait()
+        self._inflight_used += 1
+        self._inflight_lock.release()
+        req = Request(None, None, callback, None)
+        try:
+            mid = self._send(topic, payload, 1, False)
+        except Exception as e:
+            self._release_slot()
+            raise e
+#-if !AWSCLOUD_LWMQTT
+        if type(mid) == PINT:
+            self._inflight_lock.acquire()
+            acked = mid in self._early_acks
+            if acked:
+                # the PUBACK arrived before publish returned
+                self._early_acks.remove(mid)
+            else:
+                self._inflight[mid] = [topic, payload, req]
+            self._inflight_lock.release()
+            if acked:
+                self._release_slot()
+                req._resolve(True, None)
+            return req
+#-endif
+        # the client waited for the PUBACK itself
+        self._release_slot()
+        if mid is False:
+            # spooled, delivered later without PUBACK tracking
+            return None
+        req._resolve(True, None)
+        return req
+
+    def _release_slot(self):
+        self._inflight_lock.acquire()
+        self._inflight_used -= 1
+        self._inflight_free.set()
+        self._inflight_lock.release()
+
+    def _handle_puback(self, client, data):
+        mid = data.get('mid') if type(data) == PDICT else data
+        self._inflight_lock.acquire()
+        entry = None
+        if mid in self._inflight:
+            entry = self._inflight.pop(mid)
+        else:
+            self._early_acks.append(mid)
+            if len(self._early_acks) > self._inflight_window:
+                self._early_acks.pop(0)
+        self._inflight_lock.release()
+        if entry is not None:
+            self._release_slot()
+            entry[2]._resolve(True, None)
+
+    def _retransmit(self):
+        # messages not acknowledged before the connection dropped are sent again
+        self._inflight_lock.acquire()
+        pending = [self._inflight[mid] for mid in self._inflight]
+        self._inflight = {}
+        self._inflight_lock.release()
+        for i in range(len(pending)):
+            entry = pending[i]
+            try:
+                mid = self._send(entry[0], entry[1], 1)
+            except Exception as e:
+                # connection lost again: fail this and the remaining messages
+                for entry in pending[i:]:
+                    self._release_slot()
+                    entry[2]._resolve(False, None)
+                raise e
+            if mid is False:
+                self._release_slot()
+                continue
+            self._inflight_lock.acquire()
+            if type(mid) == PINT:
+                self._inflight[mid] = entry
+                self._inflight_lock.release()
+            else:
+                self._inflight_lock.release()
+                self._release_slot()
+                entry[2]._resolve(True, None)
+
+    def enable_batching(self, max_size=1024, max_latency=1000, max_buffer=4096, topics=None):
+        """
+.. method:: enable_batching(max_size=1024, max_latency=1000, max_buffer=4096, topics=None)
+
+        Enable batched publishing. Payloads published to the same topic are accumulated and sent as a single message containing a JSON array of all of them.
+
+        A batch is sent when its encoded size would exceed :samp:`max_size` bytes, when its oldest payload has been waiting for :samp:`max_latency` milliseconds or when :meth:`flush` is called.
+        At most :samp:`max_buffer` bytes are kept in memory across all topics: when the limit is reached, the oldest batch is sent by the publishing thread before accepting the new payload.
+
+        If :samp:`topics` is a list of topics, only those topics are batched, otherwise every topic not starting with :samp:`$aws/` is batched.
+        Payloads must be dictionaries or JSON encoded strings::
+
+            my_thing.mqtt.enable_batching(max_size=512, max_latency=5000)
+            my_thing.mqtt.publish('dev/sample', {'asample': 1})  # buffered
+            my_thing.mqtt.publish('dev/sample', {'asample': 2})  # buffered
+            my_thing.mqtt.flush()  # sends [{"asample": 1},{"asample": 2}] to dev/sample
+
+        """
+        self.disable_batching()
+        self._batcher = _Batcher(self, max_size, max_latency, max_buffer, topics)
+
+    def disable_batching(self):
+        """
+.. method:: disable_batching()
+
+        Send all pending batches and go back to publishing every payload as soon as it is published.
+
+        """
+        if self._batcher is not None:
+            batcher = self._batcher
+            self._batcher = None
+            batcher.running = False
+            batcher.flush()
+
+    def flush(self, topic=None):
+        """
+.. method:: flush(topic=None)
+
+        Immediately send the pending batch of :samp:`topic`, or all pending batches if :samp:`topic` is None.
+
+        """
+        if self._batcher is not None:
+            self._batcher.flush(topic)
+
+class _TopicRouter():
+    # topic trie: each node is [children, handler], children are keyed by
+    # topic level and may include the '+' and '#' MQTT wildcards
+
+    def __init__(self):
+        self.root = [{}, None]
+
+    def add(self, topic_filter, handler):
+        node = self.root
+        for level in topic_filter.split('/'):
+            if level not in node[0]:
+                node[0][level] = [{}, None]
+            node = node[0][level]
+        node[1] = handler
+
+    def remove(self, topic_filter):
+        path = []
+        node = self.root
+        for level in topic_filter.split('/'):
+            if level not in node[0]:
+                return
+            path.append((node, level))
+            node = node[0][level]
+        node[1] = None
+        # prune empty branches
+        while path:
+            parent, level = path.pop()
+            child = parent[0][level]
+            if child[1] is not None or child[0]:
+                break
+            parent[0].pop(level)
+
+    def match(self, topic):
+        return self._match(self.root, topic.split('/'), 0)
+
+    def _match(self, node, levels, idx):
+        children = node[0]
+        if idx == len(levels):
+            if node[1] is not None:
+                return node[1]
+            # 'a/#' also matches 'a'
+            if '#' in children:
+                return children['#'][1]
+            return None
+        level = levels[idx]
+        # the most specific filter wins: exact level, then '+', then '#'
+        if level in children:
+            handler = self._match(children[level], levels, idx + 1)
+            if handler is not None:
+                return handler
+        if '+' in children:
+            handler = self._match(children['+'], levels, idx + 1)
+            if handler is not None:
+                return handler
+        if '#' in children:
+            return children['#'][1]
+        return None
+
+    def dispatch(self, topic, payload):
+        handler = self.match(topic)
+        if handler is None:
+            return False
+        handler(topic, payload)
+        return True
+
+#-if AWSCLOUD_LWMQTT
+class _LwRoute():
+
+    def __init__(self, router, topic_filter):
+        self.router = router
+        self.topic_filter = topic_filter
+
+    def handle(self, client, payload, topic=None):
+        self.router.dispatch(topic or self.topic_filter, payload)
+#-endif
+
+
+def _wait(evt, timeout):
+    # Event.wait with optional timeout in milliseconds, None waits forever
+    try:
+        if timeout is None:
+            evt.wait()
+        else:
+            evt.wait(timeout)
+    except Exception as e:
+        pass
+
+
+class Request():
+    """
+=================
+The Request class
+=================
+
+.. class:: Request
+
+        An in-flight request created by :meth:`Thing.request`, resolved when the reply carrying its :samp:`clientToken` is received.
+
+        After resolution, the :samp:`accepted` attribute is True if the reply came from an :samp:`accepted` topic and :samp:`response` holds
+        the reply values extracted at the requested key paths.
+    """
+
+    def __init__(self, token, paths, callback, deadline):
+        self.token = token
+        self.paths = paths
+        self.callback = callback
+        self.deadline = deadline
+        self.accepted = False
+        self.response = None
+        self._done = False
+        self._evt = threading.Event()
+
+    def _resolve(self, accepted, response):
+        self.accepted = accepted
+        self.response = response
+        self._done = True
+        # the callback runs first, so that waiters see its effects
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception as e:
+                print(e)
+        self._evt.set()
+
+    def done(self):
+        """
+.. method:: done()
+
+        Return True if a reply has been received.
+
+        """
+        return self._done
+
+    def wait(self, timeout=None):
+        """
+.. method:: wait(timeout=None)
+
+        Wait for the reply at most :samp:`timeout` milliseconds (forever if None).
+        Return True if the request has been accepted, False if it has been rejected or no reply arrived in time.
+
+        """
+        if not self._done:
+            _wait(self._evt, timeout)
+        return self._done and self.accepted
+
+
+def _diff(current, state):
+    # keys of state whose value differs from current, recursing into dicts
+    changed = {}
+    for key in state:
+        value = state[key]
+        if key not in current:
+            if value is not None:
+                changed[key] = value
+        elif type(value) == PDICT and type(current[key]) == PDICT:
+            sub = _diff(current[key], value)
+            if sub:
+                changed[key] = sub
+        elif value is None or current[key] != value:
+            changed[key] = value
+    return changed
+
+
+def _merge(current, state):
+    # apply a shadow state update to current, None values delete keys
+    for key in state:
+        value = state[key]
+        if value is None:
+            if key in current:
+                del current[key]
+        elif type(value) == PDICT:
+            if key not in current or type(current[key]) != PDICT:
+                current[key] = {}
+            _merge(current[key], value)
+        else:
+            current[key] = value
+
+
+def _overlay(current, state):
+    # like _merge, but None values are kept to be published as deletions
+    for key in state:
+        value = state[key]
+        if type(value) == PDICT and key in current and type(current[key]) == PDICT:
+            _overlay(current[key], value)
+        else:
+            current[key] = value
+
+
+def _dispatch_keys(node, state, reported):
+    # walk the delta state and the key handlers tree together, invoking only
+    # handlers whose key is present in the delta
+    for key in state:
+        if key not in node[0]:
+            continue
+        child = node[0][key]
+        value = state[key]
+        if child[1] is not None:
+            ret = child[1](value)
+            if ret is not None:
+                reported[key] = ret
+        if child[0] and type(value) == PDICT:
+            sub = {}
+            _dispatch_keys(child, value, sub)
+            if sub:
+                if type(reported.get(key)) != PDICT:
+                    reported[key] = {}
+                _overlay(reported[key], sub)
+
+
+class _ShadowUpdate():
+
+    def __init__(self, shadow, state):
+        self.shadow = shadow
+        self.state = state
+
+    def handle(self, req):
+        if req.accepted:
+            self.shadow._updated(self.state, req.response.get('version'))
+
+
+class Shadow():
+    """
+================
+The Shadow class
+================
+
+.. class:: Shadow
+
+        A local mirror of a Thing shadow document, returned by :meth:`Thing.shadow` for both the classic shadow and named shadows.
+        Each instance exposes the same get/update/delta API: splitting high-churn and low-churn state across named shadows keeps frequent updates from rewriting large documents.
+
+        The mirror holds the last known :samp:`desired` and :samp:`reported` states and the document :samp:`version` as instance attributes.
+        It is seeded by :meth:`get` and kept up to date by accepted reported state updates and incoming deltas, so that only changed keys are published
+        and stale or duplicate deltas are discarded.
+    """
+
+    def __init__(self, thing, prefix, name=None):
+        self.thing = thing
+        self.prefix = prefix
+        self.name = name
+        self.desired = {}
+        self.reported = {}
+        self.version = 0
+        # last delta applied: our own accepted updates also raise version, and
+        # AWS does not order them with deltas, so deltas are deduplicated apart
+        self._delta_version = 0
+        self._cbk = None
+        self._keys = [{}, None]
+        self._delta_subscribed = False
+        self._lock = threading.Lock()
+        self._window = 0
+        self._coalescing = False
+        self._pending = None
+        self._force = False
+        self._flush_evt = threading.Event()
+
+    def get(self, timeout=10000):
+        """
+.. method:: get(timeout=10000)
+
+        Retrieve the shadow document from the cloud and refresh the local mirror.
+        The method blocks until the document is received or :samp:`timeout` milliseconds have passed.
+
+        Return True on success, False otherwise.
+
+        """
+        if self.name is None:
+            reply_filter = self.prefix + '/get/+'
+        else:
+            reply_filter = self.thing._shadow.prefix + '/name/+/get/+'
+        req = self.thing.request(self.prefix + '/get', {}, reply_filter, ('state.desired', 'state.reported', 'version'), timeout=timeout)
+        if not req.wait(timeout):
+            return False
+        doc = req.response
+        self._lock.acquire()
+        self.desired = doc.get('state.desired') or {}
+        self.reported = doc.get('state.reported') or {}
+        self.version = doc.get('version', 0)
+        self._delta_version = self.version
+        self._lock.release()
+        return True
+
+    def update(self, state, force=False):
+        """
+.. method:: update(state, force=False)
+
+        Update the shadow with reported :samp:`state` state.
+
+        Only keys whose value differs from the local mirror of the reported state are published, unless :samp:`force` is True.
+        The mirror is updated when the cloud accepts the update, so that a lost or rejected update is published again by the next :meth:`update`.
+        Return True if a shadow update has been published, False if there was nothing to update or the update could not be published.
+
+        When coalescing is enabled (see :meth:`coalesce`), the state is merged into the pending update and True is returned.
+
+        """
+        if self._window:
+            self._lock.acquire()
+            if self._pending is None:
+                self._pending = {}
+                self._flush_evt.set()
+            _overlay(self._pending, state)
+            self._force = self._force or force
+            self._lock.release()
+            return True
+        return self._publish(state, force)
+
+    def _publish(self, state, force):
+        self._lock.acquire()
+        if not force:
+            state = _diff(self.reported, state)
+        self._lock.release()
+        if not state:
+            return False
+        if self.name is None:
+            # not update/+: update/documents would bring the whole document back on every update
+            reply_filter = (self.prefix + '/update/accepted', self.prefix + '/update/rejected')
+        else:
+            named = self.thing._shadow.prefix + '/name/+/update/'
+            reply_filter = (named + 'accepted', named + 'rejected')
+        # the mirror is updated only once the cloud has accepted the new state
+        req = self.thing.request(self.prefix + '/update', { 'state': { 'reported': state }}, reply_filter, ('version',), _ShadowUpdate(self, state).handle)
+        return not req.done() or req.accepted
+
+    def _updated(self, state, version):
+        self._lock.acquire()
+        _merge(self.reported, state)
+        if version is not None and version > self.version:
+            self.version = version
+        self._lock.release()
+
+    def coalesce(self, window):
+        """
+.. method:: coalesce(window)
+
+        Merge reported state updates issued within :samp:`window` milliseconds into a single shadow update.
+        The first :meth:`update` of a burst starts the window, following updates overwrite pending values key by key, and at the end of the window the merged state is published.
+
+        A :samp:`window` of 0 disables coalescing, publishing any pending update.
+
+        """
+        self._window = window
+        if not window:
+            self.flush()
+            # wake up the coalescing thread to let it exit
+            self._flush_evt.set()
+        elif not self._coalescing:
+            self._coalescing = True
+            threading.Thread(target=self._coalesce_loop).start()
+
+    def flush(self):
+        """
+.. method:: flush()
+
+        Immediately publish the pending coalesced update, if any. Return True if a shadow update has been published.
+
+        """
+        self._lock.acquire()
+        state = self._pending
+        force = self._force
+        self._pending = None
+        self._force = False
+        self._flush_evt.clear()
+        self._lock.release()
+        if state is None:
+            return False
+        return self._publish(state, force)
+
+    def _coalesce_loop(self):
+        while True:
+            self._flush_evt.wait()
+            window = self._window
+            if not window:
+                break
+            sleep(window)
+            try:
+                self.flush()
+            except Exception as e:
+                print(e)
+        self._flush_evt.clear()
+        self._coalescing = False
+
+    def _handle_delta(self, topic, payload):
+        # skip the metadata section, as large as the state itself
+        delta = jsonscan.extract(payload, ('state', 'version'))
+        if 'state' not in delta:
+            return
+        self._lock.acquire()
+        version = delta.get('version', 0)
+        stale = version and version <= self._delta_version
+        if not stale:
+            if version:
+                self._delta_version = version
+                if version > self.version:
+                    self.version = version
+            _merge(self.desired, delta['state'])
+        self._lock.release()
+        if stale:
+            return
+        self.thing._dispatch(self.prefix + '/update/delta', self._run_delta, delta['state'])
+
+    def _run_delta(self, state):
+        reported = {}
+        if self._keys[0]:
+            _dispatch_keys(self._keys, state, reported)
+        if self._cbk is not None:
+            ret = self._cbk(state)
+            if ret is not None:
+                _overlay(reported, ret)
+        if reported:
+            self.update(reported)
+
+    def _subscribe_delta(self):
+        if not self._delta_subscribed:
+            self._delta_subscribed = True
+            self._subscribe('/update/delta', self._handle_delta)
+
+    def _subscribe(self, suffix, handler):
+#-if !AWSCLOUD_LWMQTT
+        if self.name is None:
+            self.thing.subscribe(self.prefix + suffix, handler)
+        else:
+            # named shadows share a wildcard subscription owned by the Thing
+            self.thing._subscribe_named(suffix)
+#-else
+        # lwmqtt may not pass the actual topic to wildcard handlers, so the
+        # shadow name could not be recovered from it: subscribe each shadow
+        self.thing.subscribe(self.prefix + suffix, handler)
+#-endif
+
+    def on_delta(self, delta_cbk):
+        """
+.. method:: on_delta(delta_cbk)
+
+        Set a callback to be called with the requested state on shadow deltas. If a dictionary is returned, it is published as reported state.
+
+        """
+        self._cbk = delta_cbk
+        self._subscribe_delta()
+
+    def on_key(self, key_path, handler):
+        """
+.. method:: on_key(key_path, handler)
+
+        Set :samp:`handler` to be called with the requested value of :samp:`key_path` when it appears in a delta.
+        :samp:`key_path` is a dot separated path into the shadow state, like :samp:`"led.color"`. If the handler returns a value other than None, it is reported as the new value of :samp:`key_path`.
+
+        """
+        node = self._keys
+        for key in key_path.split('.'):
+            if key not in node[0]:
+                node[0][key] = [{}, None]
+            node = node[0][key]
+        node[1] = handler
+        self._subscribe_delta()
+
+
+class Dispatcher():
+    """
+====================
+The Dispatcher class
+====================
+
+.. class:: Dispatcher(workers=1, queue_size=8, policy=Dispatcher.BLOCK)
+
+        A bounded queue served by :samp:`workers` threads, used by :meth:`Thing.set_dispatcher` to run user callbacks off the MQTT receive thread.
+
+        When :samp:`queue_size` callbacks are already waiting, :samp:`policy` decides what happens to a new one:
+
+        * :samp:`Dispatcher.BLOCK`, the submitting thread waits for a free slot;
+        * :samp:`Dispatcher.DROP_OLDEST`, the oldest waiting callback is discarded;
+        * :samp:`Dispatcher.COALESCE`, a waiting callback with the same key (e.g. the same topic) is replaced by the new one even if the queue is not full, otherwise the oldest one is discarded.
+    """
+    BLOCK = 0
+    DROP_OLDEST = 1
+    COALESCE = 2
+
+    def __init__(self, workers=1, queue_size=8, policy=0):
+        self.queue_size = queue_size
+        self.policy = policy
+        self.items = []
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.not_empty = threading.Event()
+        self.not_full = threading.Event()
+        self.not_full.set()
+        for i in range(workers):
+            threading.Thread(target=self._work).start()
+
+    def _metric(self, key):
+        # [waiting, max waiting, dropped, executed]
+        if key not in self.metrics:
+            self.metrics[key] = [0, 0, 0, 0]
+        return self.metrics[key]
+
+    def submit(self, key, fn, arg):
+        """
+.. method:: submit(key, fn, arg)
+
+        Queue the call :samp:`fn(arg)`, accounted under :samp:`key`.
+
+        """
+        while True:
+            self.lock.acquire()
+            if self.policy == Dispatcher.COALESCE:
+                for item in self.items:
+                    if item[0] == key:
+                        item[1] = fn
+                        item[2] = arg
+                        self._metric(key)[2] += 1
+                        self.lock.release()
+                        return
+            if len(self.items) < self.queue_size or self.policy != Dispatcher.BLOCK:
+                break
+            self.not_full.clear()
+            self.lock.release()
+            self.not_full.wait()
+        if len(self.items) >= self.queue_size:
+            dropped = self.items.pop(0)
+            metric = self._metric(dropped[0])
+            metric[0] -= 1
+            metric[2] += 1
+        self.items.append([key, fn, arg])
+        metric = self._metric(key)
+        metric[0] += 1
+        if metric[0] > metric[1]:
+            metric[1] = metric[0]
+        self.not_empty.set()
+        self.lock.release()
+
+    def _work(self):
+        while True:
+            self.not_empty.wait()
+            self.lock.acquire()
+            if not self.items:
+                self.not_empty.clear()
+                self.lock.release()
+                continue
+            key, fn, arg = self.items.pop(0)
+            metric = self._metric(key)
+            metric[0] -= 1
+            self.not_full.set()
+            self.lock.release()
+            try:
+                fn(arg)
+            except Exception as e:
+                print(e)
+            metric[3] += 1
+
+    def stats(self):
+        """
+.. method:: stats()
+
+        Return a dictionary mapping each callback key to a list with the number of queued calls, the maximum queue depth reached, the number of dropped (or coalesced) calls and the number of executed calls.
+
+        """
+        return self.metrics
+
+
+# AWS IoT accepts at most 8 subscriptions per SUBSCRIBE request
+_MAX_SUBSCRIBE_TOPICS = 8
+
 
 class Thing:
     """
@@ -111,7 +1316,7 @@ class Thing:
 The Thing class
 ===============
 
-.. class:: Thing(endpoint, mqtt_id, clicert, pkey, thingname=None, cacert=None)
+.. class:: Thing(endpoint, mqtt_id, clicert, pkey, thingname=None, cacert=None, clean_session=True)
 
         Create a Thing instance representing an AWS IoT Thing.
 
@@ -129,55 +1334,292 @@ The Thing class
             ...
             my_thing.mqtt.loop()
 
+        The client also supports batched publishing of telemetry, see :meth:`AWSMQTTClient.enable_batching`.
+
         A :samp:`thingname` different from chosen MQTT id can be specified, otherwise :samp:`mqtt_id` will be assumed also as Thing name.
+
+        With :samp:`clean_session` set to False the client connects with a persistent session: topics are subscribed with QoS 1, so that the broker keeps the messages
+        (e.g. job notifications) received while the device is offline and delivers them after the reconnection.
+        The MQTT client does not report the CONNACK session present flag, so subscriptions are still restored after each reconnection.
     """
 
-    def __init__(self, endpoint, mqtt_id, clicert, pkey, thingname=None, cacert=None):
+    def __init__(self, endpoint, mqtt_id, clicert, pkey, thingname=None, cacert=None, clean_session=True):
         global legacy_and_amazon_cas
         if cacert is None:
             cacert = legacy_and_amazon_cas
         else:
             legacy_and_amazon_cas = None
         self.ctx = ssl.create_ssl_context(cacert=cacert,clicert=clicert,pkey=pkey,options=ssl.CERT_REQUIRED|ssl.SERVER_AUTH)
-        self.mqtt = AWSMQTTClient(mqtt_id, endpoint, self.ctx)
+        self.mqtt = AWSMQTTClient(mqtt_id, endpoint, self.ctx, clean_session)
         self.thingname = (thingname or mqtt_id)
 
-        self._shadow_cbk = None
         self._client_token = ''.join([ str(xx) for xx in mcu.uid()])
+        self._router = _TopicRouter()
+        self._routing = False
+        self._shadow = Shadow(self, '$aws/things/' + self.thingname + '/shadow')
+        self._named = {}
+        self._named_subs = []
+        self._requests = {}
+        self._reply_filters = []
+        self._request_seq = 0
+        self._request_lock = threading.Lock()
+        self._dispatcher = None
+        self._subscriptions = []
+        self.mqtt._connect_hooks.append(self._resubscribe)
 
-    def update_shadow(self, state):
+    def subscribe(self, topic, handler):
         """
-.. method:: update_shadow(state)
+.. method:: subscribe(topic, handler)
 
-        Update thing shadow with reported :samp:`state` state.
+        Subscribe to :samp:`topic` and route its messages to :samp:`handler`.
 
-        :samp:`state` must be a dictionary containing only custom state keys and values::
+        :samp:`topic` can contain MQTT wildcards. Every subscription of the Thing shares a single topic dispatch table, so that each incoming message is routed to exactly one handler, the one with the most specific matching topic.
+        Subscriptions are remembered and restored after each reconnection (see :meth:`AWSMQTTClient.set_reconnect_backoff`), sending as many topics per SUBSCRIBE request as AWS IoT accepts.
+        :samp:`handler` is called with the message topic and payload as parameters::
 
-            my_thing.update_shadow({'publish_period': 1000})
+            def on_command(topic, payload):
+                print(topic, payload)
 
+            my_thing.subscribe('dev/commands/+', on_command)
+
+        """
+#-if !AWSCLOUD_LWMQTT
+        if not self._routing:
+            self._routing = True
+            self.mqtt.on(mqtt.PUBLISH, self._route, self._is_routed)
+#-endif
+        self._router.add(topic, handler)
+        if topic not in self._subscriptions:
+            self._subscriptions.append(topic)
+#-if !AWSCLOUD_LWMQTT
+        self.mqtt.subscribe([[topic, self._subscribe_qos()]])
+#-else
+        self.mqtt.subscribe(topic, _LwRoute(self._router, topic).handle, self._subscribe_qos())
+#-endif
+
+    def _subscribe_qos(self):
+        # the broker only stores QoS 1 messages for persistent sessions
+        return 0 if self.mqtt.clean_session else 1
+
+    def unsubscribe(self, topic):
         """
-        shadow_rep = { 'state': { 'reported': state }}
-        self.mqtt.publish('$aws/things/' + self.thingname + '/shadow/update', json.dumps(shadow_rep))
+.. method:: unsubscribe(topic)
+
+        Unsubscribe from :samp:`topic` and remove its handler.
 
+        """
 #-if !AWSCLOUD_LWMQTT
-    def _is_shadow_delta(self, mqtt_data):
-        if ('message' in mqtt_data):
-            return (mqtt_data['message'].topic == ('$aws/things/' + self.thingname + '/shadow/update/delta'))
-        return False
+        self.mqtt.unsubscribe([topic])
+#-else
+        self.mqtt.unsubscribe(topic)
 #-endif
+        self._router.remove(topic)
+        if topic in self._subscriptions:
+            self._subscriptions.remove(topic)
 
+    def _resubscribe(self):
+        # restore every subscription after a reconnection, in as few SUBSCRIBE packets as AWS allows
+        if not self._subscriptions:
+            return
+        qos = self._subscribe_qos()
 #-if !AWSCLOUD_LWMQTT
-    def _handle_shadow_request(self, mqtt_client, mqtt_data):
-        reported = self._shadow_cbk(json.loads(mqtt_data['message'].payload)['state'])
-        if reported is not None:
-            self.update_shadow(reported)
+        for i in range(0, len(self._subscriptions), _MAX_SUBSCRIBE_TOPICS):
+            self.mqtt.subscribe([[topic, qos] for topic in self._subscriptions[i:i + _MAX_SUBSCRIBE_TOPICS]])
 #-else
-    def _handle_shadow_request(self, mqtt_client, payload):
-        reported = self._shadow_cbk(json.loads(payload)['state'])
-        if reported is not None:
-            self.update_shadow(reported)
+        for topic in self._subscriptions:
+            self.mqtt.subscribe(topic, _LwRoute(self._router, topic).handle, qos)
+#-endif
+
+#-if !AWSCLOUD_LWMQTT
+    def _is_routed(self, mqtt_data):
+        # claim only the topics subscribed through the Thing, leaving the others to the application callbacks
+        if 'message' in mqtt_data:
+            return self._router.match(mqtt_data['message'].topic) is not None
+        return False
+
+    def _route(self, mqtt_client, mqtt_data):
+        self._router.dispatch(mqtt_data['message'].topic, mqtt_data['message'].payload)
 #-endif
 
+    def set_dispatcher(self, workers=1, queue_size=8, policy=Dispatcher.BLOCK):
+        """
+.. method:: set_dispatcher(workers=1, queue_size=8, policy=Dispatcher.BLOCK)
+
+        Run shadow callbacks (and the job callbacks of the FOTA module) in a pool of :samp:`workers` threads instead of the MQTT receive thread, so that a slow callback does not
+        stall the reception of other messages and keepalives. Callbacks wait in a queue of :samp:`queue_size` items handled according to :samp:`policy` (see :class:`Dispatcher`)::
+
+            my_thing.set_dispatcher(workers=2, queue_size=4, policy=iot.Dispatcher.COALESCE)
+            ...
+            print(my_thing.dispatcher().stats())
+
+        """
+        self._dispatcher = Dispatcher(workers, queue_size, policy)
+
+    def dispatcher(self):
+        """
+.. method:: dispatcher()
+
+        Return the :class:`Dispatcher` set by :meth:`set_dispatcher`, or None.
+
+        """
+        return self._dispatcher
+
+    def _dispatch(self, key, fn, arg):
+        if self._dispatcher is None:
+            fn(arg)
+        else:
+            self._dispatcher.submit(key, fn, arg)
+
+    def request(self, topic, msg, reply_filter, paths=(), callback=None, timeout=10000):
+        """
+.. method:: request(topic, msg, reply_filter, paths=(), callback=None, timeout=10000)
+
+        Publish the request :samp:`msg` dictionary to :samp:`topic` and return a :class:`Request` resolved by the reply received on :samp:`reply_filter` topics
+        (for example :samp:`$aws/things/<thing>/jobs/+/get/+`, or a tuple of topic filters), extracting the :samp:`paths` key paths from the reply. If :samp:`paths` is None, the raw reply payload is kept instead.
+
+        Reply topics are subscribed on first use and kept subscribed, and each request is tagged with a unique :samp:`clientToken`, so that many requests can be in flight at the same time
+        without any SUBSCRIBE/UNSUBSCRIBE round trip. :samp:`callback`, if given, is called with the resolved request on the MQTT receive thread.
+        Requests not resolved after :samp:`timeout` milliseconds are forgotten and their reply, if ever received, is ignored.
+        A request that could not be published is returned already resolved as rejected, with a None :samp:`response`.
+
+        """
+        now = timers.now()
+        self._request_lock.acquire()
+        # forget expired requests so that lost replies don't leak memory
+        for token in [t for t in self._requests if self._requests[t].deadline is not None and self._requests[t].deadline < now]:
+            del self._requests[token]
+        self._request_seq += 1
+        token = self._client_token + ':' + str(self._request_seq)
+        req = Request(token, paths, callback, None if timeout is None else now + timeout)
+        self._requests[token] = req
+        filters = (reply_filter,) if type(reply_filter) == type('') else reply_filter
+        subscribe = [topic_filter for topic_filter in filters if topic_filter not in self._reply_filters]
+        for topic_filter in subscribe:
+            self._reply_filters.append(topic_filter)
+        self._request_lock.release()
+        for topic_filter in subscribe:
+            self.subscribe(topic_filter, self._handle_reply)
+        msg['clientToken'] = token
+        try:
+            sent = self.mqtt.publish(topic, json.dumps(msg))
+        except Exception as e:
+            sent = False
+        if sent is False:
+            # not sent (e.g. rejected by the rate limiter): resolve it as rejected
+            self._request_lock.acquire()
+            if token in self._requests:
+                del self._requests[token]
+            self._request_lock.release()
+            req._resolve(False, None)
+        return req
+
+    def _handle_reply(self, topic, payload):
+        token = jsonscan.extract(payload, ('clientToken',)).get('clientToken')
+        self._request_lock.acquire()
+        req = None
+        if token in self._requests:
+            req = self._requests.pop(token)
+        self._request_lock.release()
+        if req is not None:
+            if topic.endswith('/accepted') or topic.endswith('/rejected'):
+                accepted = topic.endswith('/accepted')
+            else:
+                # the topic filter itself (lwmqtt): AWS error responses, and only them, carry a code
+                accepted = 'code' not in jsonscan.extract(payload, ('code',))
+            if req.paths is None:
+                req._resolve(accepted, payload)
+            else:
+                req._resolve(accepted, jsonscan.extract(payload, req.paths))
+
+    def shadow(self, name=None):
+        """
+.. method:: shadow(name=None)
+
+        Return the :class:`Shadow` instance mirroring the classic thing shadow or, if :samp:`name` is given, the named shadow :samp:`name`::
+
+            config = my_thing.shadow('config')
+            config.on_delta(config_callback)
+            telemetry = my_thing.shadow('telemetry')
+            telemetry.update({'temp': 21})
+
+        All named shadows share a single wildcard subscription per reply topic (e.g. :samp:`$aws/things/<thing>/shadow/name/+/update/delta`) and
+        messages are routed to the right instance by shadow name, so adding named shadows does not add subscriptions (except with the lwmqtt client, where each named shadow subscribes its own delta topic).
+
+        """
+        if name is None:
+            return self._shadow
+        if name not in self._named:
+            self._named[name] = Shadow(self, self._shadow.prefix + '/name/' + name, name)
+        return self._named[name]
+
+    def _subscribe_named(self, suffix):
+        if suffix not in self._named_subs:
+            self._named_subs.append(suffix)
+            self.subscribe(self._shadow.prefix + '/name/+' + suffix, self._route_named)
+
+    def _route_named(self, topic, payload):
+        # $aws/things/<thing>/shadow/name/<name>/<get|update>/<reply>
+        levels = topic.split('/')
+        if len(levels) < 8 or levels[5] not in self._named:
+            return
+        shadow = self._named[levels[5]]
+        if levels[7] == 'delta':
+            shadow._handle_delta(topic, payload)
+
+    def get_shadow(self, timeout=10000):
+        """
+.. method:: get_shadow(timeout=10000)
+
+        Retrieve the thing shadow document and seed the local shadow mirror with its desired state, reported state and version.
+        Calling it right after the connection allows the first :meth:`update_shadow` to publish only what actually changed.
+
+        Return True on success, False if the document could not be retrieved within :samp:`timeout` milliseconds.
+
+        """
+        return self._shadow.get(timeout)
+
+    def update_shadow(self, state, force=False):
+        """
+.. method:: update_shadow(state, force=False)
+
+        Update thing shadow with reported :samp:`state` state.
+
+        :samp:`state` must be a dictionary containing only custom state keys and values::
+
+            my_thing.update_shadow({'publish_period': 1000})
+
+        Only keys whose value changed with respect to the last reported state accepted by the cloud are published: if nothing changed no message is sent at all.
+        Set :samp:`force` to True to publish the whole :samp:`state` anyway.
+        Return True if a shadow update has been published.
+
+        """
+        return self._shadow.update(state, force)
+
+    def coalesce_shadow(self, window):
+        """
+.. method:: coalesce_shadow(window)
+
+        Enable coalescing of reported state updates: calls to :meth:`update_shadow` issued within :samp:`window` milliseconds
+        are merged into a single shadow update, the last value written for a key winning. Shadow updates are billed and throttled per message, so merging bursts reduces both cost and throttling::
+
+            my_thing.coalesce_shadow(500)
+            my_thing.update_shadow({'temp': 21})
+            my_thing.update_shadow({'hum': 40, 'temp': 22})  # a single update {'temp': 22, 'hum': 40} is published
+
+        Pass 0 to disable coalescing.
+
+        """
+        self._shadow.coalesce(window)
+
+    def flush_shadow(self):
+        """
+.. method:: flush_shadow()
+
+        Publish the pending coalesced shadow update right away.
+
+        """
+        return self._shadow.flush()
+
     def on_shadow_request(self, shadow_cbk):
         """
 .. method:: on_shadow_request(shadow_cbk)
@@ -192,15 +1634,30 @@ The Thing class
             my_thing.on_shadow_request(shadow_callback)
 
         If a dictionary is returned, it is automatically published as reported state.
+        Deltas whose version is not newer than the last one seen are considered stale or duplicated and are discarded.
         """
-        if self._shadow_cbk is None:
-#-if !AWSCLOUD_LWMQTT
-            self.mqtt.subscribe([['$aws/things/' + self.thingname + '/shadow/update/delta',0]])
-#-else
-            self.mqtt.subscribe('$aws/things/' + self.thingname + '/shadow/update/delta', self._handle_shadow_request)
-#-endif
-        self._shadow_cbk = shadow_cbk
-#-if !AWSCLOUD_LWMQTT
-        self.mqtt.on(mqtt.PUBLISH, self._handle_shadow_request, self._is_shadow_delta)
-#-endif
+        self._shadow.on_delta(shadow_cbk)
+
+    def on_shadow_key(self, key_path, handler):
+        """
+.. method:: on_shadow_key(key_path, handler)
+
+        Set a callback to be called only when :samp:`key_path` is part of a shadow update request.
 
+        :samp:`key_path` is a dot separated path into the shadow state, allowing handlers for nested keys. :samp:`handler` is called with the requested value as the only parameter
+        and, if it returns something other than None, the returned value is reported for :samp:`key_path`. The values returned by all the handlers invoked for a delta (and by the :meth:`on_shadow_request` callback, if any) are merged into a single shadow update::
+
+            def set_period(period):
+                global publish_period
+                publish_period = period
+                return period
+
+            def set_color(color):
+                led.set(color)
+                return color
+
+            my_thing.on_shadow_key('publish_period', set_period)
+            my_thing.on_shadow_key('led.color', set_color)
+
+        """
+        self._shadow.on_key(key_path, handler)
@@ -10,12 +10,55 @@ The Zerynth AWS IoT Jobs Library can be used to handle `IoT Jobs <https://docs.a
     """
 
 import threading
+import timers
 import json
-#-if AWSCLOUD_LWMQTT
-from lwmqtt import mqtt
-#-else
-from mqtt import mqtt
-#-endif
+from aws.iot import jsonscan
+
+class _JobCache():
+    # least recently used job executions, keyed by jobId and versionNumber;
+    # entries are [jobid, version, execution, size], most recent last
+
+    def __init__(self,max_entries,max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = []
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self,jobid,version):
+        execution = None
+        self.lock.acquire()
+        for i,entry in enumerate(self.entries):
+            if entry[0]==jobid and entry[1]==version:
+                if i!=len(self.entries)-1:
+                    self.entries.append(self.entries.pop(i))
+                execution = entry[2]
+                break
+        self.lock.release()
+        return execution
+
+    def put(self,execution):
+        if not self.max_entries:
+            return
+        size = len(json.dumps(execution["jobDocument"]))
+        self.lock.acquire()
+        self._put(execution,size)
+        self.lock.release()
+
+    def _put(self,execution,size):
+        jobid = execution["jobId"]
+        # a new version supersedes the older ones of the same job
+        for i,entry in enumerate(self.entries):
+            if entry[0]==jobid:
+                self.size-=self.entries.pop(i)[3]
+                break
+        if size>self.max_bytes:
+            return
+        self.entries.append([jobid,execution["versionNumber"],execution,size])
+        self.size+=size
+        while len(self.entries)>self.max_entries or self.size>self.max_bytes:
+            self.size-=self.entries.pop(0)[3]
+
 
 class Jobs():
     """
@@ -23,37 +66,111 @@ class Jobs():
 Jobs class
 ==========
 
-.. class:: Jobs(thing)
+.. class:: Jobs(thing,cache_size=8,cache_bytes=4096)
 
     This class allows the retrieval of the :samp:`thing` job list.
     
     It requires the connection to thw MQTT broker to be already established: It subscribes to various
     topic to receive jobs notifications.
 
+    Job executions received from describe, start-next and notify-next messages are kept in a cache keyed by jobId and versionNumber, so that jobs whose version
+    has not changed since the last time are described locally. At most :samp:`cache_size` executions are kept, with their job documents taking at most :samp:`cache_bytes` bytes;
+    least recently used executions are evicted first. Set :samp:`cache_size` to 0 to disable the cache.
+
+    Job notifications are used to keep a local index of the pending jobs (see :meth:`pending`) and to push new jobs to the handlers registered with :meth:`on_operation`,
+    without polling :meth:`changed` and calling :meth:`list`.
+
     """
-    def __init__(self,thing):
+    def __init__(self,thing,cache_size=8,cache_bytes=4096):
         self.thing = thing
-        self.evt = threading.Event()
-        self.job_data = None
         self.chprefix = "$aws/things/"+self.thing.thingname+"/jobs"
-        self.topic = self.chprefix+"/get/accepted"
+        self._cache = _JobCache(cache_size,cache_bytes)
+        self._index = {}
+        self._handlers = {}
+        self._dispatched = []
+        self._dispatch_evt = threading.Event()
         #subscribe to notify
-#-if !AWSCLOUD_LWMQTT
-        self.thing.mqtt.subscribe([[self.chprefix+"/notify", 0]])
-        self.thing.mqtt.on(mqtt.PUBLISH, self._handle_notify, self._is_notify)
-#-else
-        self.thing.mqtt.subscribe(self.chprefix+"/notify", self._handle_notify)
-#-endif
         self._changed = False
+        self.thing.subscribe(self.chprefix+"/notify", self._handle_notify)
+        self.thing.subscribe(self.chprefix+"/notify-next", self._handle_notify_next)
+
+    def _handle_notify(self,topic,payload):
+        jbs = jsonscan.extract(payload,("jobs",)).get("jobs")
+        if jbs is not None:
+            self._update_index(jbs.get("IN_PROGRESS") or [],jbs.get("QUEUED") or [])
+        self._changed = True
+
+    def _update_index(self,inprogress,queued):
+        # the notify payload lists all pending jobs: rebuild the index from it
+        index = {}
+        for item in inprogress:
+            index[item["jobId"]] = (Job.IN_PROGRESS,item.get("versionNumber"))
+        for item in queued:
+            index[item["jobId"]] = (Job.QUEUED,item.get("versionNumber"))
+        self._index = index
+        if self._handlers:
+            self._dispatch_evt.set()
+
+    def pending(self):
+        """
+    .. method:: pending()
+
+        Return the local index of pending jobs as a dictionary mapping each jobId to a tuple with its status and version number.
+        The index is updated by job notifications, without any request to the cloud.
+
+        """
+        return self._index
+
+    def on_operation(self,operation,handler):
+        """
+    .. method:: on_operation(operation,handler)
+
+        Set :samp:`handler` to be called with every new pending job (a described :class:`Job` instance) whose document has :samp:`operation` as :samp:`"operation"` field.
+
+        Handlers are called by a dedicated thread as soon as a job notification is received, and each job is passed to a handler only once. The handler is responsible
+        of updating the job status::
 
-#-if !AWSCLOUD_LWMQTT
-    def _is_notify(self,data):
-        if 'message' in data:
-            return data['message'].topic.startswith(self.chprefix+"/notify")
-        return False
-#-endif
+            def reboot_job(job):
+                job.update(jobs.Job.SUCCEEDED)
+                mcu.reset()
 
-    def _handle_notify(self,client,data):
+            myjobs.on_operation("reboot", reboot_job)
+            myjobs.on_operation("fota", awsfota.handle_fota_job)
+
+        """
+        start = not self._handlers
+        self._handlers[operation] = handler
+        if start:
+            threading.Thread(target=self._dispatch_loop).start()
+
+    def _dispatch_loop(self):
+        # seed the index, later kept up to date by notifications
+        inp,inq = self.list()
+        self._update_index([{"jobId":job.jobid,"versionNumber":job.version} for job in inp],[{"jobId":job.jobid,"versionNumber":job.version} for job in inq])
+        while True:
+            self._dispatch_evt.wait()
+            self._dispatch_evt.clear()
+            index = self._index
+            # forget jobs that are no longer pending
+            self._dispatched = [jobid for jobid in self._dispatched if jobid in index]
+            for jobid in index:
+                if jobid in self._dispatched:
+                    continue
+                job = Job(self.thing,jobid,self,index[jobid][1])
+                if not job.describe():
+                    continue
+                self._dispatched.append(jobid)
+                op = job.document.get("operation") if type(job.document)==PDICT else None
+                if op in self._handlers:
+                    try:
+                        self._handlers[op](job)
+                    except Exception as e:
+                        print(e)
+
+    def _handle_notify_next(self,topic,payload):
+        execution = jsonscan.extract(payload,("execution",)).get("execution")
+        if execution is not None and "jobDocument" in execution:
+            self._cache.put(execution)
         self._changed = True
         
 
@@ -68,63 +185,95 @@ Jobs class
         self._changed = False
         return ret
 
-    def _handle_job(self,client,data,topic=None):
-#-if !AWSCLOUD_LWMQTT
-        self.job_data = json.loads(data["message"].payload)
-#-else
-        self.job_data = json.loads(data)
-#-endif
-        self.evt.set()
-
-#-if !AWSCLOUD_LWMQTT
-    def _is_job(self,data):
-        if 'message' in data:
-            return data['message'].topic.startswith(self.topic)
-        return False
-#-endif
-
-    def list(self):
+    def list(self,timeout=10000):
         """
-    .. method:: list()
+    .. method:: list(timeout=10000)
     
         Retrieve the list of jobs for the current Thing. The result value is a tuple with two items. The first item is the list of IN_PROGRESS jobs, while the second item is the list of QUEUED jobs (as :class:`Job` instances). 
 
-        This method is *blocking*. Control is not released until the list of jobs is retrieved. Moreover, it is not safe to call the method from different threads.
+        This method is *blocking*. Control is not released until the list of jobs is retrieved or :samp:`timeout` milliseconds have passed, in which case two empty lists are returned.
+        It can be safely called from different threads.
 
         """
-        self.job_data = None
-#-if !AWSCLOUD_LWMQTT
-        self.thing.mqtt.subscribe([[self.topic, 0]])
-        self.thing.mqtt.on(mqtt.PUBLISH, self._handle_job, self._is_job)
-#-else
-        self.thing.mqtt.subscribe(self.topic, self._handle_job)
-#-endif
-        msg = {'clientToken': self.thing._client_token}
-
-        self.thing.mqtt.publish(self.chprefix+'/get', json.dumps(msg))
-        self.evt.wait()
-        self.evt.clear()
-#-if !AWSCLOUD_LWMQTT
-        self.thing.mqtt.unsubscribe([self.topic])
-#-else
-        self.thing.mqtt.unsubscribe(self.topic)
-#-endif
         inp = []
         inq = []
-        if not self.job_data:
-            return inp,inq
-        if "inProgressJobs" in self.job_data:
-            for item in self.job_data["inProgressJobs"]:
-                job = Job(self.thing,item["jobId"])
+        for job in self.iter(timeout=timeout):
+            if job.status==Job.IN_PROGRESS:
                 inp.append(job)
-        if "queuedJobs" in self.job_data:
-            for item in self.job_data["queuedJobs"]:
-                job = Job(self.thing,item["jobId"])
+            else:
                 inq.append(job)
-
-        self.job_data = None
         return inp,inq
 
+    def iter(self,offset=0,limit=None,timeout=10000):
+        """
+    .. method:: iter(offset=0,limit=None,timeout=10000)
+
+        Retrieve the pending jobs of the current Thing and iterate over them, IN_PROGRESS jobs first, then QUEUED ones. Each job is yielded as a :class:`Job` handle with :samp:`status` and :samp:`version` set,
+        decoded from the reply one at a time: no list of jobs is ever built. Job handles are lightweight and allocate topic strings and other resources only when they are used.
+
+        Jobs can be paginated by skipping the first :samp:`offset` jobs and yielding at most :samp:`limit` jobs::
+
+            for job in myjobs.iter(offset=20, limit=10):
+                print(job, job.status)
+
+        Nothing is yielded if the jobs can't be retrieved within :samp:`timeout` milliseconds.
+
+        """
+        req = self.thing.request(self.chprefix+'/get', {}, self.chprefix+"/get/+", None, timeout=timeout)
+        if not req.wait(timeout):
+            return
+        payload = req.response
+        req.response = None
+        idx = 0
+        for path in ("inProgressJobs","queuedJobs"):
+            status = Job.IN_PROGRESS if path=="inProgressJobs" else Job.QUEUED
+            for item in jsonscan.items(payload,path):
+                if limit is not None and idx>=offset+limit:
+                    return
+                if idx>=offset:
+                    yield Job(self.thing,item["jobId"],self,item.get("versionNumber"),status)
+                idx+=1
+
+    def start_next(self,status_details=None,timeout=10000):
+        """
+    .. method:: start_next(status_details=None,timeout=10000)
+
+        Get and start the next pending job: the job is placed in the IN_PROGRESS status and returned as a :class:`Job` instance with :samp:`status`, :samp:`version`, :samp:`status_details` and :samp:`document` already set,
+        all in a single round trip. If the next pending job is already IN_PROGRESS it is returned unchanged. The optional :samp:`status_details` are associated to the job status.
+
+        Return None if there are no pending jobs or no reply arrived within :samp:`timeout` milliseconds.
+
+        Together with the :samp:`notify-next` topic, which marks the Jobs as :meth:`changed` whenever the next pending job changes, this is the fastest way to pick up new jobs.
+
+        """
+        msg = {}
+        if status_details is not None:
+            msg["statusDetails"] = status_details
+        req = self.thing.request(self.chprefix+'/start-next', msg, self.chprefix+"/start-next/+", ("execution",), timeout=timeout)
+        if not req.wait(timeout) or "execution" not in req.response:
+            return None
+        execution = req.response["execution"]
+        job = Job(self.thing,execution["jobId"],self)
+        if not job._from_execution(execution):
+            return None
+        return job
+
+    def describe_all(self,jobs,timeout=10000):
+        """
+    .. method:: describe_all(jobs,timeout=10000)
+
+        Describe all the :class:`Job` instances in :samp:`jobs` at once: requests are pipelined and replies collected as they arrive, so that the whole operation takes a single round trip.
+
+        Return the list of jobs successfully described.
+
+        """
+        reqs = [None if job._describe_cached() else job._describe_request(timeout) for job in jobs]
+        described = []
+        for i,job in enumerate(jobs):
+            if reqs[i] is None or job._describe_result(reqs[i],timeout):
+                described.append(job)
+        return described
+
 
 class Job():
     """
@@ -132,7 +281,7 @@ class Job():
 Job class
 =========
 
-.. class:: Job(thing,jobid)
+.. class:: Job(thing,jobid,jobs=None,version=None,status=None)
 
     This class abstracts an IoT Job related to a particular :samp:`thing` and having jobId :samp:`jobid`.
     There is no need to manually create instances of this class, they are returned by methods of the :class:`Jobs` class.
@@ -143,87 +292,76 @@ Job class
     FAILED = "FAILED"
     SUCCEEDED = "SUCCEEDED"
     REJECTED = "REJECTED"
+
+    # job handles can be many: keep them small and allocate topics and
+    # progress reporting state only when needed
+    __slots__ = ("thing","jobid","jobs","version","status","status_details","document","_prefix","_progress")
     
-    def __init__(self,thing,jobid):
+    def __init__(self,thing,jobid,jobs=None,version=None,status=None):
         self.thing = thing
         self.jobid = jobid
-        self.chprefix = "$aws/things/"+self.thing.thingname+"/jobs/"+self.jobid
-        self.evt = threading.Event()
-
-    def _handle_job(self,client,data):
-#-if !AWSCLOUD_LWMQTT
-        self.job_data = json.loads(data["message"].payload)
-#-else
-        self.job_data = json.loads(data)
-#-endif
-        self.evt.set()
+        self.jobs = jobs
+        self.version = version
+        self.status = status
+        self.status_details = None
+        self.document = None
+        self._prefix = None
+        self._progress = None
+
+    def _jprefix(self):
+        return "$aws/things/"+self.thing.thingname+"/jobs"
+
+    def _topic(self,suffix):
+        if self._prefix is None:
+            self._prefix = self._jprefix()+"/"+self.jobid
+        return self._prefix+suffix
+
+    def _describe_request(self,timeout):
+        return self.thing.request(self._topic('/get'), {}, self._jprefix()+"/+/get/+", ("execution",), timeout=timeout)
+
+    def _describe_result(self,req,timeout):
+        if not req.wait(timeout) or "execution" not in req.response:
+            return False
+        return self._from_execution(req.response["execution"])
 
-#-if !AWSCLOUD_LWMQTT        
-    def _is_job(self,data):
-        if 'message' in data:
-            return data['message'].topic.startswith(self.chprefix)
-        return False
-#-endif
-
-    def _handle_upd_job(self,client,data):
-#-if !AWSCLOUD_LWMQTT        
-        upd = json.loads(data["message"].payload)
-#-else
-        upd = json.loads(data)
-#-endif
-        self.job_data = upd["executionState"]["status"]
-        self.evt.set()
+    def _describe_cached(self):
+        if self.jobs is None or self.version is None:
+            return False
+        execution = self.jobs._cache.get(self.jobid,self.version)
+        return execution is not None and self._from_execution(execution,False)
 
-#-if !AWSCLOUD_LWMQTT        
-    def _is_upd_job(self,data):
-        if 'message' in data:
-            return data['message'].topic.startswith(self.chprefix+"/update")
-        return False
-#-endif
+    def _from_execution(self,execution,cache=True):
+        try:
+            self.status = execution["status"]
+            self.version = execution["versionNumber"]
+            self.document = execution["jobDocument"]
+        except Exception as e:
+            return False
+        self.status_details = execution.get("statusDetails") or {}
+        if cache and self.jobs is not None:
+            self.jobs._cache.put(execution)
+        return True
 
-    def describe(self):
+    def describe(self,timeout=10000):
         """
-    .. method:: describe()
+    .. method:: describe(timeout=10000)
 
-        Retrieves data about the job. In particular the fields :samp:`version`, :samp:`status` and :samp:`document` are associated to the job instance after a successful :samp:`describe`.
+        Retrieves data about the job. In particular the fields :samp:`version`, :samp:`status`, :samp:`status_details` and :samp:`document` are associated to the job instance after a successful :samp:`describe`.
+        If the job :samp:`version` is known (e.g. for jobs returned by :meth:`Jobs.list`) and the same version of the job is in the Jobs cache, the description is served locally without any round trip.
         
-        This method is *blocking*. Control is not released until the job description is retrieved. Moreover, it is not safe to call the method from different threads.
+        This method is *blocking*. Control is not released until the job description is retrieved or :samp:`timeout` milliseconds have passed. Requests are correlated to their replies,
+        so the method can be called from different threads and many descriptions can be in flight at the same time.
 
         Return True on success, False otherwise.
 
         """
-        self.job_data = None
-#-if !AWSCLOUD_LWMQTT        
-        self.thing.mqtt.subscribe([[self.chprefix+"/get/accepted", 0]])
-        self.thing.mqtt.on(mqtt.PUBLISH, self._handle_job, self._is_job)
-#-else
-        self.thing.mqtt.subscribe(self.chprefix+"/get/accepted",self._handle_job)
-#-endif
-
-        msg = {'clientToken': self.thing._client_token}
-        self.thing.mqtt.publish(self.chprefix+'/get', json.dumps(msg))
-        self.evt.wait()
-        self.evt.clear()
-#-if !AWSCLOUD_LWMQTT        
-        self.thing.mqtt.unsubscribe([self.chprefix+"/get/accepted"])
-#-else
-        self.thing.mqtt.unsubscribe(self.chprefix+"/get/accepted")
-#-endif
-        if self.job_data is None:
-            return False
-        try:
-            self.status = self.job_data["execution"]["status"]
-            self.version = self.job_data["execution"]["versionNumber"]
-            self.document = self.job_data["execution"]["jobDocument"]
-        except Exception as e:
-            self.job_data = None
-            return False
-        self.job_data = None
-        return True
+        if self._describe_cached():
+            return True
+        return self._describe_result(self._describe_request(timeout),timeout)
        
-    def update(self,status,status_details={}):
+    def update(self,status,status_details={},timeout=10000):
         """
-    .. method:: update(status,status_details={})
+    .. method:: update(status,status_details={},timeout=10000)
 
         Updates the status of the job. The :samp:`status` can be one of the following class constant:
 
@@ -233,18 +371,12 @@ Job class
 
         The optional field :samp:`status_details` can contain custom values that are associated to the job status.
 
-        This method is *blocking*. Control is not released until the status change is signaled. Moreover, it is not safe to call the method from different threads.
+        This method is *blocking*. Control is not released until the status change is signaled or :samp:`timeout` milliseconds have passed. It can be safely called from different threads.
 
         Return True on success, False otherwise.
 
         """
-        self.job_data = ""
-#-if !AWSCLOUD_LWMQTT 
-        self.thing.mqtt.subscribe([[self.chprefix+"/update/", 0]])
-        self.thing.mqtt.on(mqtt.PUBLISH, self._handle_upd_job, self._is_upd_job)
-#-else
-        self.thing.mqtt.subscribe(self.chprefix+"/update/#",self._handle_upd_job)
-#-endif
+        self._stop_progress(timeout)
         msg = {
             "status":status,
             "statusDetails":status_details,
@@ -252,16 +384,275 @@ Job class
             "includeJobExecutionState": True,
             # "includeJobDocument": True
         }
-        self.thing.mqtt.publish(self.chprefix+'/update', json.dumps(msg))
-        self.evt.wait()
-        self.evt.clear()
-#-if !AWSCLOUD_LWMQTT        
-        self.thing.mqtt.unsubscribe([self.chprefix+"/update/#"])
-#-else
-        self.thing.mqtt.unsubscribe(self.chprefix+"/update/#")
-#-endif
-        return self.job_data == status
+        req = self.thing.request(self._topic('/update'), msg, self._jprefix()+"/+/update/+", ("executionState.status","executionState.versionNumber"), timeout=timeout)
+        if not req.wait(timeout):
+            return False
+        if "executionState.versionNumber" in req.response:
+            self.version = req.response["executionState.versionNumber"]
+        self.status = req.response.get("executionState.status")
+        if self.status == status:
+            self.status_details = status_details
+            if self.jobs is not None and self.document is not None:
+                self.jobs._cache.put({"jobId":self.jobid,"status":status,"statusDetails":status_details,"versionNumber":self.version,"jobDocument":self.document})
+        return self.status == status
+
+    def report_progress(self,status_details,interval=5000):
+        """
+    .. method:: report_progress(status_details,interval=5000)
+
+        Report the progress of an IN_PROGRESS job by merging :samp:`status_details` into the job status details, without blocking.
+
+        Reports are coalesced: at most one job update is published every :samp:`interval` milliseconds, carrying the latest value of every reported key.
+        Replies are handled asynchronously, keeping the job version up to date for the next update; a report rejected because of a version mismatch is retried with the correct version.
+        Pending reports are discarded by :meth:`update`, which is meant to set the final job status::
+
+            for chunk in chunks:
+                process(chunk)
+                job.report_progress({"done": chunk.idx, "total": len(chunks)})
+            job.update(jobs.Job.SUCCEEDED)
+
+        """
+        if self._progress is None:
+            self._progress = _JobProgress()
+        pr = self._progress
+        pr.lock.acquire()
+        pr.interval = interval
+        if pr.pending is None:
+            pr.pending = {}
+            start = True
+        else:
+            start = False
+        for key in status_details:
+            pr.pending[key] = status_details[key]
+        pr.lock.release()
+        if start:
+            threading.Thread(target=self._progress_loop).start()
+
+    def _progress_loop(self):
+        pr = self._progress
+        while True:
+            pr.lock.acquire()
+            now = timers.now()
+            req = pr.req
+            if req is not None and not req.done() and req.deadline is not None and req.deadline < now:
+                # reply lost
+                req = pr.req = None
+            wait = pr.ts + pr.interval - now
+            if pr.pending is None:
+                pr.lock.release()
+                return
+            if (req is None or req.done()) and wait <= 0:
+                details = {}
+                if self.status_details:
+                    for key in self.status_details:
+                        details[key] = self.status_details[key]
+                for key in pr.pending:
+                    details[key] = pr.pending[key]
+                pr.pending = None
+                pr.ts = now
+                pr.sent = details
+                pr.req = None
+                # _stop_progress waits for the request being sent
+                pr.idle.clear()
+                pr.lock.release()
+                msg = {
+                    "status":Job.IN_PROGRESS,
+                    "statusDetails":details,
+                    "expectedVersion":self.version,
+                    "includeJobExecutionState": True,
+                }
+                try:
+                    req = self.thing.request(self._topic('/update'), msg, self._jprefix()+"/+/update/+", ("executionState.versionNumber",), self._progress_done, pr.interval or 10000)
+                    pr.lock.acquire()
+                    if not req.done():
+                        pr.req = req
+                    pr.lock.release()
+                finally:
+                    pr.idle.set()
+                return
+            pr.lock.release()
+            sleep(max(wait,50))
+
+    def _progress_done(self,req):
+        if "executionState.versionNumber" in req.response:
+            self.version = req.response["executionState.versionNumber"]
+        pr = self._progress
+        start = False
+        pr.lock.acquire()
+        details = pr.sent
+        if details is None:
+            # stopped by update()
+            pass
+        elif req.accepted:
+            self.status_details = details
+        elif "executionState.versionNumber" in req.response:
+            # version mismatch: send again with the right version
+            if pr.pending is None:
+                pr.pending = {}
+                start = True
+            for key in details:
+                if key not in pr.pending:
+                    pr.pending[key] = details[key]
+        pr.lock.release()
+        if start:
+            threading.Thread(target=self._progress_loop).start()
+
+    def _stop_progress(self,timeout):
+        pr = self._progress
+        if pr is None:
+            return
+        pr.lock.acquire()
+        pr.pending = None
+        pr.sent = None
+        pr.lock.release()
+        # a report may be in the middle of being sent
+        pr.idle.wait()
+        pr.lock.acquire()
+        req = pr.req
+        pr.req = None
+        pr.lock.release()
+        if req is not None:
+            req.wait(timeout)
 
     
     def __str__(self):
         return self.jobid+"@"+self.thing.thingname
+
+
+class _JobProgress():
+    __slots__ = ("lock","pending","req","ts","interval","sent","idle")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = None
+        self.req = None
+        self.ts = 0
+        self.interval = 0
+        self.sent = None
+        self.idle = threading.Event()
+        self.idle.set()
+
+
+class JobExecutor():
+    """
+=================
+JobExecutor class
+=================
+
+.. class:: JobExecutor(handler,concurrency=2,timeout=60000)
+
+    This class runs independent jobs in parallel, passing each of them to :samp:`handler` in a separate thread. At most :samp:`concurrency` jobs run at the same time, the others wait in a queue.
+
+    Job status transitions are automatic: a job is placed IN_PROGRESS (if not already) before calling the handler, and SUCCEEDED or FAILED depending on the handler result:
+
+    * if the handler returns False, raises an exception or does not return within :samp:`timeout` milliseconds, the job FAILED;
+    * otherwise the job SUCCEEDED. If the handler returns a dictionary, it is used as the status details of the job.
+
+    A handler exceeding the timeout can't be stopped: its job is marked FAILED and its result is ignored. ::
+
+        def diagnostic(job):
+            return {"rssi": wifi.link_info()[3]}
+
+        executor = jobs.JobExecutor(diagnostic, concurrency=3, timeout=30000)
+        awsfota.handle_fota_jobs(myjobs, force=True, executor=executor)
+
+    """
+    def __init__(self,handler,concurrency=2,timeout=60000):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._queue = []
+        self._busy = []
+        self._workers = 0
+        self._lock = threading.Lock()
+
+    def busy(self,jobid):
+        """
+    .. method:: busy(jobid)
+
+        Return True if the job with jobId :samp:`jobid` is queued or running.
+
+        """
+        return jobid in self._busy
+
+    def submit(self,job):
+        """
+    .. method:: submit(job)
+
+        Queue :samp:`job` for execution, without blocking. Return False if the job is already queued or running.
+
+        """
+        self._lock.acquire()
+        if job.jobid in self._busy:
+            self._lock.release()
+            return False
+        self._busy.append(job.jobid)
+        self._queue.append(job)
+        start = self._workers<self.concurrency
+        if start:
+            self._workers+=1
+        self._lock.release()
+        if start:
+            threading.Thread(target=self._work).start()
+        return True
+
+    def _work(self):
+        while True:
+            self._lock.acquire()
+            if not self._queue:
+                self._workers-=1
+                self._lock.release()
+                return
+            job = self._queue.pop(0)
+            self._lock.release()
+            try:
+                self._execute(job)
+            except Exception as e:
+                print(e)
+            self._lock.acquire()
+            self._busy.remove(job.jobid)
+            self._lock.release()
+
+    def _execute(self,job):
+        if job.document is None and not job.describe():
+            return
+        if job.status!=Job.IN_PROGRESS and not job.update(Job.IN_PROGRESS):
+            return
+        run = _JobRun(self.handler,job)
+        threading.Thread(target=run.run).start()
+        if self.timeout is None:
+            run.evt.wait()
+        else:
+            try:
+                run.evt.wait(self.timeout)
+            except Exception as e:
+                pass
+        if not run.done:
+            job.update(Job.FAILED,{"reason":"timeout"})
+        elif run.error is not None:
+            job.update(Job.FAILED,{"reason":run.error})
+        elif run.result is False:
+            job.update(Job.FAILED)
+        elif type(run.result)==PDICT:
+            job.update(Job.SUCCEEDED,run.result)
+        else:
+            job.update(Job.SUCCEEDED)
+
+
+class _JobRun():
+
+    def __init__(self,handler,job):
+        self.handler = handler
+        self.job = job
+        self.done = False
+        self.result = None
+        self.error = None
+        self.evt = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.handler(self.job)
+        except Exception as e:
+            self.error = str(e)
+        self.done = True
+        self.evt.set()
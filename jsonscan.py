@@ -0,0 +1,210 @@
+"""
+.. module:: aws_iot_jsonscan
+
+*****************************
+Partial JSON Scanning Library
+*****************************
+
+Shadow and job documents received from AWS IoT often carry much more than what a device needs: shadow deltas include a :samp:`metadata`
+section as large as the state itself and job executions embed the whole job document. Decoding them with :samp:`json.loads` materializes every value on the heap.
+
+This module scans the raw payload buffer without decoding it and returns only the values found at the requested key paths,
+so that just those values are ever materialized::
+
+    from aws.iot import jsonscan
+
+    found = jsonscan.extract(payload, ('state', 'version'))
+    if 'state' in found:
+        print(found['state'], found.get('version'))
+
+    """
+
+import json
+
+_WS = ' \t\r\n'
+_STOP = ' \t\r\n,}]'
+
+
+def _tokens(payload):
+    # the scanner works on str, bytes and bytearray: single characters of
+    # the payload are compared with tokens of the same kind
+    if type(payload) == type(''):
+        return '"', '\\', '{', '}', '[', ']', ':', ',', _WS, _STOP
+    return 34, 92, 123, 125, 91, 93, 58, 44, [ord(c) for c in _WS], [ord(c) for c in _STOP]
+
+
+class _Scanner():
+
+    def __init__(self, payload):
+        self.buf = payload
+        self.size = len(payload)
+        self.QUOTE, self.ESC, self.LBRACE, self.RBRACE, self.LBRACKET, self.RBRACKET, self.COLON, self.COMMA, self.WS, self.STOP = _tokens(payload)
+        self.is_str = type(payload) == type('')
+
+    def skip_ws(self, i):
+        while i < self.size and self.buf[i] in self.WS:
+            i += 1
+        return i
+
+    def skip_string(self, i):
+        # i points to the opening quote, return the index after the closing one
+        i += 1
+        while i < self.size:
+            c = self.buf[i]
+            if c == self.ESC:
+                i += 2
+                continue
+            if c == self.QUOTE:
+                return i + 1
+            i += 1
+        raise ValueError
+
+    def skip_value(self, i):
+        # i points to the first character of a value, return the index after it
+        c = self.buf[i]
+        if c == self.QUOTE:
+            return self.skip_string(i)
+        if c == self.LBRACE or c == self.LBRACKET:
+            depth = 0
+            while i < self.size:
+                c = self.buf[i]
+                if c == self.QUOTE:
+                    i = self.skip_string(i)
+                    continue
+                if c == self.LBRACE or c == self.LBRACKET:
+                    depth += 1
+                elif c == self.RBRACE or c == self.RBRACKET:
+                    depth -= 1
+                    if depth == 0:
+                        return i + 1
+                i += 1
+            raise ValueError
+        while i < self.size and self.buf[i] not in self.STOP:
+            i += 1
+        return i
+
+    def key(self, start, end):
+        # keys are compared as str, without materializing escapes
+        key = self.buf[start + 1:end - 1]
+        if not self.is_str:
+            key = bytes(key).decode('utf-8')
+        return key
+
+    def decode(self, start, end):
+        return json.loads(self.buf[start:end])
+
+    def scan(self, i, node, prefix, found, left):
+        # scan the object starting at i, looking for the keys of node. Return
+        # the index after the object and the number of paths still missing
+        i = self.skip_ws(i)
+        if self.buf[i] != self.LBRACE:
+            return self.skip_value(i), left
+        i = self.skip_ws(i + 1)
+        if self.buf[i] == self.RBRACE:
+            return i + 1, left
+        while True:
+            kend = self.skip_string(i)
+            key = self.key(i, kend)
+            i = self.skip_ws(kend)
+            if self.buf[i] != self.COLON:
+                raise ValueError
+            i = self.skip_ws(i + 1)
+            if key in node:
+                child = node[key]
+                if child is None:
+                    end = self.skip_value(i)
+                    found[prefix + key] = self.decode(i, end)
+                    i = end
+                    left -= 1
+                else:
+                    i, left = self.scan(i, child, prefix + key + '.', found, left)
+            else:
+                i = self.skip_value(i)
+            if left == 0:
+                return i, 0
+            i = self.skip_ws(i)
+            if self.buf[i] == self.COMMA:
+                i = self.skip_ws(i + 1)
+            elif self.buf[i] == self.RBRACE:
+                return i + 1, left
+            else:
+                raise ValueError
+
+    def locate(self, i, keys):
+        # return the index of the value found at keys in the object at i, or -1
+        i = self.skip_ws(i)
+        if self.buf[i] != self.LBRACE:
+            return -1
+        i = self.skip_ws(i + 1)
+        if self.buf[i] == self.RBRACE:
+            return -1
+        while True:
+            kend = self.skip_string(i)
+            key = self.key(i, kend)
+            i = self.skip_ws(kend)
+            if self.buf[i] != self.COLON:
+                raise ValueError
+            i = self.skip_ws(i + 1)
+            if key == keys[0]:
+                if len(keys) == 1:
+                    return i
+                return self.locate(i, keys[1:])
+            i = self.skip_ws(self.skip_value(i))
+            if self.buf[i] == self.COMMA:
+                i = self.skip_ws(i + 1)
+            else:
+                return -1
+
+
+def _tree(paths):
+    # build a tree of wanted keys from dotted paths, leaves are None
+    tree = {}
+    for path in paths:
+        node = tree
+        keys = path.split('.')
+        for key in keys[:-1]:
+            if node.get(key) is None:
+                node[key] = {}
+            node = node[key]
+        node[keys[-1]] = None
+    return tree
+
+
+def extract(payload, paths):
+    """
+.. function:: extract(payload, paths)
+
+    Scan the JSON object in :samp:`payload` (a string, bytes or bytearray) and decode only the values found at :samp:`paths`.
+    :samp:`paths` is a list or tuple of dot separated key paths, like :samp:`"execution.jobDocument"`.
+
+    Return a dictionary mapping each path found in :samp:`payload` to its decoded value. Missing paths are not present in the result.
+    Scanning stops as soon as all paths have been found.
+
+    """
+    found = {}
+    if not paths:
+        return found
+    scanner = _Scanner(payload)
+    scanner.scan(0, _tree(paths), '', found, len(paths))
+    return found
+
+
+def items(payload, path):
+    """
+.. function:: items(payload, path)
+
+    Iterate over the elements of the JSON array found at :samp:`path` (a dot separated key path) in :samp:`payload`, decoding one element at a time.
+    Nothing is yielded if :samp:`path` is missing or is not an array.
+
+    """
+    scanner = _Scanner(payload)
+    i = scanner.locate(0, path.split('.'))
+    if i < 0 or scanner.buf[i] != scanner.LBRACKET:
+        return
+    i = scanner.skip_ws(i + 1)
+    while i < scanner.size and scanner.buf[i] != scanner.RBRACKET:
+        end = scanner.skip_value(i)
+        yield scanner.decode(i, end)
+        i = scanner.skip_ws(end)
+        if i < scanner.size and scanner.buf[i] == scanner.COMMA:
+            i = scanner.skip_ws(i + 1)
@@ -0,0 +1,93 @@
+"""
+.. module:: aws_iot_lzss
+
+**********************
+LZSS Streaming Library
+**********************
+
+A small window LZSS format suited to microcontrollers: decompression needs a 1 KB history buffer and works on a stream of chunks of any size,
+so that a compressed firmware image can be expanded while it is being downloaded.
+
+The compressed stream is a sequence of groups, each made of a flag byte followed by up to 8 items, one for each bit of the flag byte starting from the least significant:
+
+    * a bit set to 1 marks a literal, stored as a single byte;
+    * a bit set to 0 marks a match, stored as two bytes :samp:`hi, lo`: the 10 bits :samp:`(hi & 0x03) << 8 | lo` are the distance minus 1 of the repeated data and the 6 bits :samp:`hi >> 2` are its length minus 3.
+
+Images are compressed on the host with the :samp:`benchmarks/lzss_compress.py` script of this library, which runs with CPython and is not meant for the device::
+
+    python benchmarks/lzss_compress.py firmware.bin firmware.lzss
+
+and expanded on the device while they are downloaded::
+
+    from aws.iot import lzss
+
+    decoder = lzss.Decoder()
+    for chunk in chunks:
+        data = decoder.feed(chunk)
+
+    """
+
+WINDOW = 1024
+MIN_MATCH = 3
+MAX_MATCH = 66
+
+
+class Decoder():
+    """
+=================
+The Decoder class
+=================
+
+.. class:: Decoder()
+
+        Create a streaming decoder.
+
+    """
+
+    def __init__(self):
+        self.window = bytearray(WINDOW)
+        self.pos = 0
+        self.flags = 0
+        self.nflags = 0
+        self.hi = -1
+        self.total = 0
+
+    def feed(self, data):
+        """
+.. method:: feed(data)
+
+        Decode the compressed bytes in :samp:`data` and return a bytearray with the decompressed data. Items split across chunks are completed by the next call.
+
+        """
+        out = bytearray()
+        window = self.window
+        pos = self.pos
+        for c in data:
+            if self.hi >= 0:
+                # second byte of a match
+                dist = ((self.hi & 0x03) << 8 | c) + 1
+                n = (self.hi >> 2) + MIN_MATCH
+                self.hi = -1
+                src = pos - dist
+                for i in range(n):
+                    b = window[(src + i) & (WINDOW - 1)]
+                    window[pos & (WINDOW - 1)] = b
+                    pos += 1
+                    out.append(b)
+                continue
+            if not self.nflags:
+                self.flags = c
+                self.nflags = 8
+                continue
+            literal = self.flags & 1
+            self.flags >>= 1
+            self.nflags -= 1
+            if literal:
+                window[pos & (WINDOW - 1)] = c
+                pos += 1
+                out.append(c)
+            else:
+                self.hi = c
+        self.pos = pos & (WINDOW - 1)
+        self.total += len(out)
+        return out
@@ -0,0 +1,170 @@
+"""
+.. module:: aws_iot_md5
+
+***********************
+Incremental MD5 Library
+***********************
+
+A small MD5 implementation that hashes data as it arrives, so that a firmware image can be verified while it is being downloaded instead of being read back from flash afterwards.
+
+The implementation is pure Python and processes one byte at a time: it is far slower than a native digest (see :samp:`benchmarks/bench_md5.py`) and it relies on integer arithmetic
+wider than 32 bits for its intermediate results. Measure it on the target before preferring it to a native read back of the written data.
+
+The hash state can be exported and restored, allowing the computation to be resumed later (e.g. after an interrupted download)::
+
+    from aws.iot import md5
+
+    h = md5.MD5()
+    h.update(chunk1)
+    saved = h.state()
+    ...
+    h = md5.MD5(saved)
+    h.update(chunk2)
+    print(h.hexdigest())
+
+    """
+
+_S = (7, 12, 17, 22, 5, 9, 14, 20, 4, 11, 16, 23, 6, 10, 15, 21)
+
+_K = (
+    0xd76aa478, 0xe8c7b756, 0x242070db, 0xc1bdceee, 0xf57c0faf, 0x4787c62a, 0xa8304613, 0xfd469501,
+    0x698098d8, 0x8b44f7af, 0xffff5bb1, 0x895cd7be, 0x6b901122, 0xfd987193, 0xa679438e, 0x49b40821,
+    0xf61e2562, 0xc040b340, 0x265e5a51, 0xe9b6c7aa, 0xd62f105d, 0x02441453, 0xd8a1e681, 0xe7d3fbc8,
+    0x21e1cde6, 0xc33707d6, 0xf4d50d87, 0x455a14ed, 0xa9e3e905, 0xfcefa3f8, 0x676f02d9, 0x8d2a4c8a,
+    0xfffa3942, 0x8771f681, 0x6d9d6122, 0xfde5380c, 0xa4beea44, 0x4bdecfa9, 0xf6bb4b60, 0xbebfbc70,
+    0x289b7ec6, 0xeaa127fa, 0xd4ef3085, 0x04881d05, 0xd9d4d039, 0xe6db99e5, 0x1fa27cf8, 0xc4ac5665,
+    0xf4292244, 0x432aff97, 0xab9423a7, 0xfc93a039, 0x655b59c3, 0x8f0ccc92, 0xffeff47d, 0x85845dd1,
+    0x6fa87e4f, 0xfe2ce6e0, 0xa3014314, 0x4e0811a1, 0xf7537e82, 0xbd3af235, 0x2ad7d2bb, 0xeb86d391,
+)
+
+_M = 0xffffffff
+
+
+class MD5():
+    """
+=============
+The MD5 class
+=============
+
+.. class:: MD5(state=None)
+
+        Create a new MD5 hash, or resume the one exported by :meth:`state`.
+
+    """
+
+    def __init__(self, state=None):
+        self.buf = bytearray(64)
+        if state is None:
+            self.h = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476]
+            self.count = 0
+        else:
+            self.h = list(state[0])
+            self.count = state[1]
+            tail = state[2]
+            for i in range(len(tail)):
+                self.buf[i] = tail[i]
+
+    def state(self):
+        """
+.. method:: state()
+
+        Return the current hash state as a list :samp:`[words, count, tail]`, with the four state words, the number of bytes hashed so far and the bytes not yet processed (less than a block).
+        The state can be JSON encoded and passed back to :class:`MD5` to resume hashing.
+
+        """
+        return [list(self.h), self.count, [self.buf[i] for i in range(self.count % 64)]]
+
+    def _block(self, x):
+        # x holds the 16 little endian words of a block
+        a, b, c, d = self.h
+        for i in range(64):
+            r = i >> 4
+            if r == 0:
+                f = (b & c) | (~b & d)
+                g = i
+            elif r == 1:
+                f = (d & b) | (~d & c)
+                g = (5 * i + 1) & 15
+            elif r == 2:
+                f = b ^ c ^ d
+                g = (3 * i + 5) & 15
+            else:
+                f = c ^ (b | (~d & _M))
+                g = (7 * i) & 15
+            f = (f + a + _K[i] + x[g]) & _M
+            s = _S[(r << 2) | (i & 3)]
+            a = d
+            d = c
+            c = b
+            b = (b + (((f << s) | (f >> (32 - s))) & _M)) & _M
+        h = self.h
+        h[0] = (h[0] + a) & _M
+        h[1] = (h[1] + b) & _M
+        h[2] = (h[2] + c) & _M
+        h[3] = (h[3] + d) & _M
+
+    def _words(self, data, i):
+        return [data[j] | (data[j + 1] << 8) | (data[j + 2] << 16) | (data[j + 3] << 24) for j in range(i, i + 64, 4)]
+
+    def update(self, data):
+        """
+.. method:: update(data)
+
+        Hash the bytes (or bytearray) :samp:`data`.
+
+        """
+        n = len(data)
+        fill = self.count % 64
+        self.count += n
+        i = 0
+        if fill:
+            # complete the pending block first
+            while i < n and fill < 64:
+                self.buf[fill] = data[i]
+                fill += 1
+                i += 1
+            if fill < 64:
+                return
+            self._block(self._words(self.buf, 0))
+        while i + 64 <= n:
+            self._block(self._words(data, i))
+            i += 64
+        j = 0
+        while i < n:
+            self.buf[j] = data[i]
+            i += 1
+            j += 1
+
+    def digest(self):
+        """
+.. method:: digest()
+
+        Return the 16 bytes digest of the data hashed so far. Hashing can continue afterwards.
+
+        """
+        h = list(self.h)
+        buf = bytearray(self.buf)
+        count = self.count
+        bits = count * 8
+        pad = bytearray(64 - ((count + 8) % 64) + 8)
+        pad[0] = 0x80
+        for i in range(8):
+            pad[len(pad) - 8 + i] = (bits >> (8 * i)) & 0xff
+        self.update(pad)
+        res = bytearray(16)
+        for i in range(4):
+            for j in range(4):
+                res[i * 4 + j] = (self.h[i] >> (8 * j)) & 0xff
+        self.h = h
+        self.buf = buf
+        self.count = count
+        return res
+
+    def hexdigest(self):
+        """
+.. method:: hexdigest()
+
+        Return the digest as a string of lowercase hexadecimal digits.
+
+        """
+        return ''.join(['%02x' % b for b in self.digest()])